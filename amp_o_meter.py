@@ -4,21 +4,29 @@ if sys.version_info[0] < 3:
     print('You need to run this with Python 3')
     sys.exit(1)
 
-from time      import time, sleep, strftime, localtime
-from tkinter   import *
-from tkinter   import ttk
+from time      import time, sleep, strftime, localtime, monotonic, perf_counter
+
+# when the script started loading, to report how long it takes to start measuring
+STARTED = monotonic()
+
 from threading import Thread
-import RPi.GPIO as GPIO
 import traceback
 import os
 import argparse
 import json
-import statistics
+import math
+import signal
 import threading
+from collections import deque, namedtuple
+from array     import array
+from history   import CsvHistoryWriter, BinaryHistoryWriter, BINARY_RECORD
+from tick_sources import GpioTickSource, GpioChipTickSource, SyntheticTickSource, ReplayTickSource, cleanup_gpio
+from rollup    import RollupStore, parse_duration
 
 class Tick:
+    __slots__ = ('direction', 'instant')
+
     GVF = 32.55
-    CHARGE_mC = 0
 
     RECHARGING = 1
     DISCHARGING = -1
@@ -28,165 +36,566 @@ class Tick:
         self.instant = instant
 
 
+class TickStore:
+    # Columnar storage for the ticks of a run: one array of instants and one
+    # of directions instead of a list of Tick objects. Totals are kept as
+    # running counters so they don't depend on how many ticks are still stored.
+    # When max_ticks is set, the oldest quarter of the stored ticks is dropped
+    # (or appended to spill_file, in the binary history record format) once
+    # the cap is hit.
+    SPILL_RECORD = BINARY_RECORD
+
+    def __init__(self, max_ticks=0, spill_file=None):
+        self.max_ticks = max_ticks
+        self.spill_file = spill_file
+        self.instants = array('d')
+        self.directions = array('b')
+        self.number_of_ticks = 0
+        self.number_of_positive_ticks = 0
+        self.number_of_negative_ticks = 0
+        self.number_of_spilled_ticks = 0
+
+    def __len__(self):
+        return len(self.instants)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Tick(instant, direction) for instant, direction in
+                    zip(self.instants[index], self.directions[index])]
+        return Tick(self.instants[index], self.directions[index])
+
+    def __iter__(self):
+        for instant, direction in zip(self.instants, self.directions):
+            yield Tick(instant, direction)
+
+    def append(self, instant, direction):
+        self.instants.append(instant)
+        self.directions.append(direction)
+
+        self.number_of_ticks += 1
+        if direction > 0:
+            self.number_of_positive_ticks += 1
+        else:
+            self.number_of_negative_ticks += 1
+
+        if self.max_ticks and len(self.instants) > self.max_ticks:
+            self.evict(max(self.max_ticks // 4, 1))
+
+    def evict(self, count):
+        if self.spill_file is not None:
+            pack = self.SPILL_RECORD.pack
+            with open(self.spill_file, 'ab') as file:
+                file.write(b''.join(pack(self.instants[i], self.directions[i]) for i in range(count)))
+            self.number_of_spilled_ticks += count
+
+        del self.instants[:count]
+        del self.directions[:count]
+
+    def clear(self):
+        self.instants = array('d')
+        self.directions = array('b')
+        self.number_of_ticks = 0
+        self.number_of_positive_ticks = 0
+        self.number_of_negative_ticks = 0
+        self.number_of_spilled_ticks = 0
+
+
+class TickRingBuffer:
+    # Preallocated single producer / single consumer queue between the GPIO
+    # callback and the ingestion worker. The producer only writes its slot and
+    # then advances write_index, the consumer only advances read_index, so no
+    # lock is needed. When the consumer falls `size` ticks behind, new ticks
+    # are counted in `overruns` instead of overwriting unread ones. Each tick
+    # also records the index of the channel it came from.
+    def __init__(self, size=4096):
+        self.size = size
+        self.instants = array('d', bytes(8 * size))
+        self.polarities = array('b', bytes(size))
+        self.channels = array('B', bytes(size))
+        self.write_index = 0
+        self.read_index = 0
+        self.overruns = 0
+
+    def __len__(self):
+        return self.write_index - self.read_index
+
+    def push(self, instant, polarity, channel=0):
+        index = self.write_index
+        if index - self.read_index >= self.size:
+            self.overruns += 1
+            return
+
+        slot = index % self.size
+        self.instants[slot] = instant
+        self.polarities[slot] = polarity
+        self.channels[slot] = channel
+        self.write_index = index + 1
+
+    def drain(self):
+        start = self.read_index
+        end = self.write_index
+        size = self.size
+        batch = [(self.instants[index % size], self.polarities[index % size], self.channels[index % size])
+                 for index in range(start, end)]
+        self.read_index = end
+        return batch
+
+
+# daemon mode: ticks kept in memory when --max_ticks isn't given, and how
+# often the status is printed (in seconds)
+DAEMON_MAX_TICKS = 1 << 16
+DAEMON_STATUS_INTERVAL = 3600
+DAEMON_ROTATE_INTERVAL = 24 * 3600
+
+
+class MovingWindow:
+    # Keeps the last `period` ticks and the sum of their directions so the
+    # windowed charge is updated in constant time (one tick in, one tick out).
+    # The oldest tick of the window is only used as the time reference, so
+    # its charge is not counted, as in the original slicing implementation.
+    def __init__(self, period):
+        self.period = period
+        self.instants = deque(maxlen=period)
+        self.directions = deque(maxlen=period)
+        self.direction_sum = 0
+
+    def add(self, instant, direction):
+        if len(self.directions) == self.period:
+            self.direction_sum -= self.directions[0]
+        self.instants.append(instant)
+        self.directions.append(direction)
+        self.direction_sum += direction
+
+    @property
+    def reference_instant(self):
+        return self.instants[0]
+
+    @property
+    def charged_ticks(self):
+        return self.direction_sum - self.directions[0]
+
+    @property
+    def number_of_intervals(self):
+        return self.period - 1
+
+    def clear(self):
+        self.instants.clear()
+        self.directions.clear()
+        self.direction_sum = 0
+
+
+class TimeWindow(MovingWindow):
+    # Same as MovingWindow but keeps the ticks of the last `seconds` instead of
+    # a fixed number of them, so the averaging window doesn't depend on the
+    # load. Each tick is removed once, so updates are still O(1) amortized.
+    # At least two ticks are kept, otherwise there would be no interval to
+    # average over when ticks are further apart than the window.
+    def __init__(self, seconds):
+        super().__init__(None)
+        self.seconds = seconds
+
+    def add(self, instant, direction):
+        self.instants.append(instant)
+        self.directions.append(direction)
+        self.direction_sum += direction
+
+        while len(self.instants) > 2 and instant - self.instants[0] > self.seconds:
+            self.instants.popleft()
+            self.direction_sum -= self.directions.popleft()
+
+    @property
+    def number_of_intervals(self):
+        return len(self.instants) - 1
+
+
+class ExponentialAverage:
+    # Exponential moving average over time of the current between consecutive
+    # ticks: an interval dt weighs 1 - exp(-dt / time_constant), so the
+    # average follows the load with the same time constant whatever the tick
+    # rate. `value` is in (signed) ticks per second and `rate` counts ticks in
+    # both directions.
+    def __init__(self, time_constant):
+        self.time_constant = time_constant
+        self.clear()
+
+    def add(self, instant, direction):
+        previous_instant = self.previous_instant
+        self.previous_instant = instant
+        if previous_instant is None:
+            return
+
+        interval = instant - previous_instant
+        if interval <= 0:
+            return
+
+        if self.primed:
+            weight = 1 - math.exp(-interval / self.time_constant)
+            self.value += weight * (direction / interval - self.value)
+            self.rate += weight * (1 / interval - self.rate)
+        else:
+            self.value = direction / interval
+            self.rate = 1 / interval
+            self.primed = True
+
+    def clear(self):
+        self.previous_instant = None
+        self.primed = False
+        self.value = 0.0
+        self.rate = 0.0
+
+
+class RunningStats:
+    # Welford's online mean/variance. With window=0 it covers every value
+    # pushed since the last clear(), otherwise only the last `window` values
+    # (the value falling out of the window is removed with the inverse update).
+    def __init__(self, window=0):
+        self.window = window
+        self.values = deque() if window else None
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        if self.values is not None:
+            if len(self.values) == self.window:
+                self.remove(self.values.popleft())
+            self.values.append(value)
+
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value):
+        if self.count <= 1:
+            self.count = 0
+            self.mean = 0.0
+            self.m2 = 0.0
+            return
+
+        old_mean = self.mean
+        self.count -= 1
+        self.mean = (old_mean * (self.count + 1) - value) / self.count
+        self.m2 = max(self.m2 - (value - old_mean) * (value - self.mean), 0.0)
+
+    @property
+    def pvariance(self):
+        if self.count == 0:
+            return 0.0
+        return self.m2 / self.count
+
+    @property
+    def pstdev(self):
+        return math.sqrt(self.pvariance)
+
+    def clear(self):
+        if self.values is not None:
+            self.values.clear()
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+
+# State of a counter published by Counter.publish(). `sequence` grows with
+# every publication, the last_* fields are those instant_current() needs and
+# the interval_* ones the statistics of the intervals between ticks.
+CounterSnapshot = namedtuple('CounterSnapshot', ['start', 'number_of_ticks', 'number_of_positive_ticks',
+                                                 'number_of_negative_ticks', 'ticks_per_second', 'accumulated_charge',
+                                                 'avg_current', 'std_deviation_current', 'file_name',
+                                                 'history_queue_depth', 'history_dropped_rows', 'instant_current',
+                                                 'sequence', 'interval_count', 'interval_mean', 'interval_pstdev',
+                                                 'last_tick_instant', 'last_interval', 'last_direction'])
+
+
 class Counter:
-    def __init__(self, create_csv, resistor_value, ma_period):
-        self.ticks = []
-        self.tick_diffs = []
+    def __init__(self, create_csv, resistor_value, ma_period, std_window=0, max_ticks=0, spill_ticks=False,
+                 csv_flush_rows=256, csv_flush_interval=1.0, history_format="csv", name="", calibration=None,
+                 rollup=False, ma_mode="ticks", ma_seconds=10.0, rotate_bytes=0, rotate_seconds=0,
+                 compress_history=False):
+        self.name = name
+        self.resistor_value = resistor_value
+        self.max_ticks = max_ticks
+        self.spill_ticks = spill_ticks
+        self.ticks = TickStore(max_ticks)
         self.accumulated_charge = 0
         self.avg_current = 0
         self.ticks_per_second = 0
         self.start = time()
         self.create_csv = create_csv
-        self.file_name = ""
-        self.create_history_file()
+        self.history_format = history_format
+        self.csv_flush_rows = csv_flush_rows
+        self.csv_flush_interval = csv_flush_interval
+        self.history_writer = None
+        # see HistoryWriter; every history file written by this counter is
+        # listed in history_segments once closed, and the rows its writer
+        # dropped added to closed_history_dropped_rows
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compress_history = compress_history
+        self.history_segments = []
+        self.closed_history_dropped_rows = 0
+        # ma_mode "ticks" averages over the last ma_period ticks (or the whole
+        # run with ma_period=0), "time" over the last ma_seconds and "ema"
+        # exponentially with a time constant of ma_seconds
+        self.ma_period = ma_period
+        self.ma_mode = ma_mode
+        self.ma_seconds = ma_seconds
+        if ma_mode != "ticks" and not ma_seconds > 0:
+            print(" --- ERROR: ma_seconds must be positive with ma_mode {}! ---".format(ma_mode))
+            raise Exception
+        self.window = None
+        self.ema = None
+        if ma_mode == "time":
+            self.window = TimeWindow(ma_seconds)
+        elif ma_mode == "ema":
+            self.ema = ExponentialAverage(ma_seconds)
+        elif ma_period != 0:
+            self.window = MovingWindow(ma_period)
         self.std_deviation_current = 0
         self.previous_tick_instant = None
-        self.ma_period = ma_period
+        # the last interval between ticks and the direction of the last tick,
+        # for instant_current()
+        self.last_interval = None
+        self.last_direction = 0
+
+        # With std_window=0 the interval statistics cover the whole run, skipping
+        # the first ma_period intervals while the moving average warms up
+        self.std_window = std_window
+        self.interval_stats = RunningStats(std_window)
+        self.number_of_intervals = 0
+
+        # per instance, so that counters for different sensors don't share it.
+        # A calibration (a, b) from calibrator.py replaces the nominal charge
+        # per tick with its slope a and adds its intercept b (in mA) to the
+        # magnitude of the current
+        self.calibration = calibration
+        if calibration is None:
+            self.charge_mC = 1/(Tick.GVF * resistor_value) * 1000
+            self.current_offset = 0
+        else:
+            self.charge_mC, self.current_offset = calibration
+        # print("---> CHARGE_mC: {}".format(self.charge_mC))
+
+        # aggregates at several resolutions, kept across resets (see rollup.py)
+        self.rollups = RollupStore(name) if rollup else None
+
+        self.file_name = ""
+        self.create_history_file()
+        self.create_spill_file()
 
-        Tick.CHARGE_mC = 1/(Tick.GVF * resistor_value) * 1000
-        # print("---> CHARGE_mC: {}".format(Tick.CHARGE_mC))
+        # Only the thread adding the ticks touches the fields above. Other
+        # threads read `published`, an immutable snapshot replaced as a whole
+        # by publish(), so they always see the state between two ticks and
+        # never wait for the writer. The owner of the counter (Controller
+        # after every batch of ticks) decides when to publish.
+        self.sequence = 0
+        self.published = None
+        self.publish()
 
     @property
     def number_of_ticks(self):
-        return len(self.ticks)
+        return self.ticks.number_of_ticks
 
     @property
     def number_of_positive_ticks(self):
-        counter = 0
-        for tick in self.ticks:
-            if tick.direction > 0:
-                counter += 1
-        return counter
+        return self.ticks.number_of_positive_ticks
 
     @property
     def number_of_negative_ticks(self):
-        counter = 0
-        for tick in self.ticks:
-            if tick.direction < 0:
-                counter += 1
-        return counter
+        return self.ticks.number_of_negative_ticks
+
+    @property
+    def total_charge(self):
+        # of the whole run, whereas accumulated_charge only covers the moving
+        # average window when there is one
+        return (self.ticks.number_of_positive_ticks - self.ticks.number_of_negative_ticks) * self.charge_mC
+
+    # history_writer is replaced by reset() in the ingestion thread while
+    # snapshot() reads these from others, so it is only read once
+    @property
+    def history_queue_depth(self):
+        history_writer = self.history_writer
+        if history_writer is None:
+            return 0
+        return history_writer.queue_depth
+
+    @property
+    def history_dropped_rows(self):
+        history_writer = self.history_writer
+        if history_writer is None:
+            return 0
+        return history_writer.dropped_rows
+
+    @property
+    def file_suffix(self):
+        if self.name:
+            return "_" + self.name
+        return ""
+
+    def publish(self):
+        # called from the thread adding the ticks
+        self.sequence += 1
+        stats = self.interval_stats
+        snapshot = CounterSnapshot(self.start, self.ticks.number_of_ticks, self.ticks.number_of_positive_ticks,
+                                   self.ticks.number_of_negative_ticks, self.ticks_per_second,
+                                   self.accumulated_charge, self.avg_current, self.std_deviation_current,
+                                   self.file_name, self.history_queue_depth, self.history_dropped_rows, 0,
+                                   self.sequence, stats.count, stats.mean, stats.pstdev if stats.count else 0.0,
+                                   self.previous_tick_instant, self.last_interval, self.last_direction)
+        self.published = snapshot._replace(instant_current=self.instant_current(self.previous_tick_instant, snapshot))
+
+    def snapshot(self, now=None):
+        # the last published state, with the values that also change between
+        # ticks (the instant current and the history queue) brought up to date
+        published = self.published
+        return published._replace(instant_current=self.instant_current(now, published),
+                                  history_queue_depth=self.history_queue_depth,
+                                  history_dropped_rows=self.history_dropped_rows)
+
+    def instant_current(self, now=None, snapshot=None):
+        # Current from the last interval between ticks, which reacts to a load
+        # change after a single tick instead of the ma_period ticks of the
+        # moving average. While the next tick is overdue the time since the
+        # last one is a lower bound of the interval, so the reading already
+        # decays when the load drops, before the next tick arrives.
+        if snapshot is None:
+            snapshot = self.published
+        last_interval = snapshot.last_interval
+        last_instant = snapshot.last_tick_instant
+        if last_interval is None or last_instant is None:
+            return 0
+        if now is None:
+            now = time()
+
+        interval = max(last_interval, now - last_instant)
+        if interval <= 0:
+            return 0
+        current = self.charge_mC * snapshot.last_direction / interval
+        if self.current_offset:
+            current += math.copysign(1, current) * self.current_offset
+        return current
 
     def create_history_file(self):
+        self.close_history_file()
+
         if self.create_csv:
             if not os.path.exists('history'):
                 os.makedirs('history')
 
-            self.file_name = "history/history_{}.csv".format(
-                                   strftime('%Y-%m-%d %H:%M:%S', localtime(time())).replace(' ', '_'))
-            with open(self.file_name, 'w') as file:
-                file.write('time_absolute,time_relative,direction,avg_current\n')
+            self.file_name = "history/history_{}{}.{}".format(
+                                   strftime('%Y-%m-%d %H:%M:%S', localtime(time())).replace(' ', '_'),
+                                   self.file_suffix, self.history_format)
+            rotation = {
+                "rotate_bytes": self.rotate_bytes,
+                "rotate_seconds": self.rotate_seconds,
+                "compress": self.compress_history,
+            }
+            if self.history_format == "bin":
+                self.history_writer = BinaryHistoryWriter(self.file_name, self.resistor_value, self.charge_mC,
+                                                          self.ma_period, self.start,
+                                                          self.csv_flush_rows, self.csv_flush_interval, **rotation)
+            else:
+                self.history_writer = CsvHistoryWriter(self.file_name, self.csv_flush_rows, self.csv_flush_interval,
+                                                       **rotation)
         else:
             self.file_name = "csv file creation deactivated"
 
-    def add_tick(self, instant, direction):
-        tick = Tick(instant, direction)
-        self.ticks.append(tick)
-
-        if self.ma_period != 0:
-            self.accumulated_charge = 0
-            reference_instant = None
-            for tick in self.ticks[-self.ma_period:]:
-                if reference_instant is None:
-                    reference_instant = tick.instant
-                else:
-                    self.accumulated_charge += tick.CHARGE_mC * tick.direction
+    def close_history_file(self):
+        if self.history_writer is not None:
+            self.history_writer.close()
+            self.history_segments += self.history_writer.segments
+            self.closed_history_dropped_rows += self.history_writer.dropped_rows
+            self.history_writer = None
+
+    def create_spill_file(self):
+        if self.max_ticks and self.spill_ticks:
+            if not os.path.exists('history'):
+                os.makedirs('history')
 
-            if time() - reference_instant > 0:
-                self.avg_current = self.accumulated_charge / (time() - reference_instant)
-                self.ticks_per_second = (self.ma_period-1) / (time() - reference_instant)
+            self.ticks.spill_file = "history/ticks_{}{}.bin".format(
+                                          strftime('%Y-%m-%d %H:%M:%S', localtime(time())).replace(' ', '_'),
+                                          self.file_suffix)
+        else:
+            self.ticks.spill_file = None
+
+    def add_tick(self, instant, direction):
+        self.ticks.append(instant, direction)
+
+        if self.window is not None:
+            self.window.add(instant, direction)
+            self.accumulated_charge = self.charge_mC * self.window.charged_ticks
+
+            elapsed = instant - self.window.reference_instant
+            if elapsed > 0:
+                self.avg_current = self.accumulated_charge / elapsed
+                self.ticks_per_second = self.window.number_of_intervals / elapsed
+        elif self.ema is not None:
+            self.accumulated_charge += self.charge_mC * direction
+            self.ema.add(instant, direction)
+
+            elapsed = instant - self.start
+            self.avg_current = self.charge_mC * self.ema.value
+            self.ticks_per_second = self.ema.rate
         else:
-            self.accumulated_charge += tick.CHARGE_mC * tick.direction
+            self.accumulated_charge += self.charge_mC * direction
 
-            if time() - self.start > 0:
-                self.avg_current = self.accumulated_charge / (time() - self.start)
-                self.ticks_per_second = (len(self.ticks)-1) / (time() - self.start)
+            elapsed = instant - self.start
+            if elapsed > 0:
+                self.avg_current = self.accumulated_charge / elapsed
+                self.ticks_per_second = (self.ticks.number_of_ticks-1) / elapsed
 
+        if self.current_offset and elapsed > 0 and self.avg_current:
+            self.avg_current += math.copysign(1, self.avg_current) * self.current_offset
 
-        # TODO: test standard deviation calculation
         if self.previous_tick_instant is None:
             self.previous_tick_instant = instant
         else:
-            self.tick_diffs.append(instant - self.previous_tick_instant)
+            self.number_of_intervals += 1
+            self.last_interval = instant - self.previous_tick_instant
+            if self.std_window or self.number_of_intervals > self.ma_period:
+                self.interval_stats.add(self.last_interval)
             self.previous_tick_instant = instant
-            if len(self.tick_diffs[self.ma_period:]) > 1:
-                mean = statistics.mean(self.tick_diffs[self.ma_period:])
-                std_deviation_timediff = statistics.pstdev(self.tick_diffs[self.ma_period:])
+
+            if self.interval_stats.count > 1:
+                mean = self.interval_stats.mean
+                std_deviation_timediff = self.interval_stats.pstdev
                 if std_deviation_timediff != 0:
-                    self.std_deviation_current = tick.CHARGE_mC/mean - tick.CHARGE_mC/(mean + std_deviation_timediff)
-                    # print("mean: {}, std_time: {}, std_cur: {}".format(mean, std_deviation_timediff, self.std_deviation_current))
+                    self.std_deviation_current = self.charge_mC/mean - self.charge_mC/(mean + std_deviation_timediff)
+        self.last_direction = direction
 
-        if self.create_csv:
-            with open(self.file_name, 'a') as file:
-                file.write('{},{},{},{}\n'.format(time(), time()-self.start, direction, self.avg_current))
+        if self.history_writer is not None:
+            self.history_writer.add((instant, instant-self.start, direction, self.avg_current))
+
+        if self.rollups is not None:
+            self.rollups.add(instant, direction, self.charge_mC)
 
     def reset(self):
-        self.ticks = []
-        self.tick_diffs = []
+        self.ticks.clear()
         self.accumulated_charge = 0
         self.avg_current = 0
         self.ticks_per_second = 0
         self.start = time()
         self.create_history_file()
+        self.create_spill_file()
         self.std_deviation_current = 0
         self.previous_tick_instant = None
-
-
-class TkGui:
-    def __init__(self):
-        root = Tk()
-        self.root = root
-
-        self.time_elapsed = StringVar()
-        self.number_of_ticks = StringVar()
-        self.total_charge = StringVar()
-        self.avg_current = StringVar()
-        self.file_name = StringVar()
-        self.resistor_value = StringVar()
-        self.charge_mc = StringVar()
-        self.std_deviation_current = StringVar()
-
-        self.ma_period = StringVar()
-        self.number_of_positive_ticks = StringVar()
-        self.number_of_negative_ticks = StringVar()
-        self.ticks_per_second = StringVar()
-
-        self.root.title("AMP-O-METER")
-
-        self.mainframe = ttk.Frame(self.root, padding="3 3 12 12")
-        self.mainframe.grid(column=0, row=0, sticky=(N, W, E, S))
-        self.mainframe.columnconfigure(0, weight=1)
-        self.mainframe.rowconfigure(0, weight=1)
-
-        ttk.Label(self.mainframe,          textvariable=self.time_elapsed).grid(column=1, row=2, sticky=(W, E))
-        ttk.Label(self.mainframe,       textvariable=self.number_of_ticks).grid(column=2, row=2, sticky=(W, E))
-        ttk.Label(self.mainframe,           textvariable=self.avg_current).grid(column=3, row=2, sticky=(W, E))
-        ttk.Label(self.mainframe,          textvariable=self.total_charge).grid(column=4, row=2, sticky=(W, E))
-        ttk.Label(self.mainframe,        textvariable=self.resistor_value).grid(column=1, row=4, sticky=(W, E))
-        ttk.Label(self.mainframe,             textvariable=self.charge_mc).grid(column=2, row=4, sticky=(W, E))
-        ttk.Label(self.mainframe, textvariable=self.std_deviation_current).grid(column=3, row=4, sticky=(W, E))
-        ttk.Label(self.mainframe,             textvariable=self.file_name).grid(column=2, row=5, sticky=(W, E), columnspan=2)
-
-        ttk.Label(self.mainframe,       text="Time elapsed:").grid(column=1, row=1, sticky=W)
-        ttk.Label(self.mainframe,        text="Total ticks:").grid(column=2, row=1, sticky=W)
-        ttk.Label(self.mainframe,   text="Avg current (mA):").grid(column=3, row=1, sticky=W)
-        ttk.Label(self.mainframe,  text="Total charge (mC):").grid(column=4, row=1, sticky=W)
-        ttk.Label(self.mainframe,     text="Resistor value:").grid(column=1, row=3, sticky=W)
-        ttk.Label(self.mainframe,        text="mC per tick:").grid(column=2, row=3, sticky=W)
-        ttk.Label(self.mainframe, text="Std deviation (mA):").grid(column=3, row=3, sticky=W)
-        ttk.Label(self.mainframe,       text="History file:").grid(column=1, row=5, sticky=W)
-
-        # self.recharge_button = ttk.Button(self.mainframe, text="Recharge tick").grid(column=1, row=3, sticky=W)
-        self.reset_button = ttk.Button(self.mainframe, text="Reset")
-        self.reset_button.grid(column=4, row=3, sticky=W, rowspan=3)
-
-        for child in self.mainframe.winfo_children():
-            child.grid_configure(padx=5, pady=5)
-
-    def run(self):
-        try:
-            self.root.mainloop()
-        finally:
-            GPIO.cleanup()
+        self.last_interval = None
+        self.last_direction = 0
+        self.interval_stats.clear()
+        self.number_of_intervals = 0
+        if self.window is not None:
+            self.window.clear()
+        if self.ema is not None:
+            self.ema.clear()
+        if self.rollups is not None:
+            self.rollups.restart()
+        self.publish()
+
+    def close(self):
+        self.close_history_file()
+        if self.rollups is not None:
+            self.rollups.close()
+            self.rollups = None
 
 
 class TerminalUI:
@@ -194,15 +603,21 @@ class TerminalUI:
         def __init__(self, description):
             self.value = ""
             self.description = description
+            self.changed = True
 
         def __str__(self):
             return "{: <22}: {} \033[K".format(self.description, self.value)
 
         def set(self, new_value):
-            self.value = str(new_value)
+            new_value = str(new_value)
+            if new_value != self.value:
+                self.value = new_value
+                self.changed = True
 
-    def __init__(self):
-        self.print_thread = threading.Thread(target=self.run, daemon=True)
+    TITLE = " ---- AMP-O-METER ---- \033[K"
+
+    def __init__(self, refresh_rate=10, headless=None):
+        self.setup_screen(refresh_rate, headless)
 
         self.time_elapsed    = self.Parameter("Time elapsed")
         self.number_of_ticks = self.Parameter("Total ticks")
@@ -211,68 +626,218 @@ class TerminalUI:
         self.ticks_per_second = self.Parameter("Ticks per second")
         self.total_charge    = self.Parameter("Total charge (mC)")
         self.avg_current     = self.Parameter("Avg current (mA)")
+        self.instant_current = self.Parameter("Instant current (mA)")
         self.file_name       = self.Parameter("History file")
+        self.history_queue   = self.Parameter("History queue")
+        self.overruns        = self.Parameter("Missed ticks (buffer)")
         self.resistor_value  = self.Parameter("Resistor value")
         self.charge_mc       = self.Parameter("mC per tick")
         self.std_deviation_current = self.Parameter("Std deviation (mA)")
         self.ma_period       = self.Parameter("Moving average period")
 
-    def run(self):
-        first_run = True
+        # display order
+        self.parameters = [
+            self.time_elapsed,
+            self.number_of_ticks,
+            self.ticks_per_second,
+            self.number_of_positive_ticks,
+            self.number_of_negative_ticks,
+            self.avg_current,
+            self.instant_current,
+            self.total_charge,
+            self.resistor_value,
+            self.charge_mc,
+            self.std_deviation_current,
+            self.file_name,
+            self.history_queue,
+            self.overruns,
+            self.ma_period,
+        ]
+
+    def setup_screen(self, refresh_rate, headless):
+        self.print_thread = threading.Thread(target=self.run, daemon=True)
+        self.refresh_rate = refresh_rate
+        # without a terminal to redraw (output redirected to a file or pipe)
+        # the screen is not drawn at all
+        if headless is None:
+            headless = not sys.stdout.isatty()
+        self.headless = headless
+        self.first_frame = True
+
+    def add_instrumentation(self):
+        # rows of --instrumentation on, filled by Controller.update_instrumentation
+        self.tick_processing = self.Parameter("Tick processing")
+        self.edge_delay = self.Parameter("Edge to counter")
+        self.suspicious_intervals = self.Parameter("Suspicious intervals")
+        self.parameters += [self.tick_processing, self.edge_delay, self.suspicious_intervals]
+
+    def render(self):
+        # Returns everything that has to be written for the next frame. The
+        # cursor is always left on the line below the last parameter, so a
+        # changed line is reached by moving up, rewritten, and left again.
+        if self.first_frame:
+            self.first_frame = False
+            lines = ["\n" + self.TITLE]
+            for parameter in self.parameters:
+                parameter.changed = False
+                lines.append(str(parameter))
+            return "\n".join(lines) + "\n"
+
+        frame = []
+        number_of_lines = len(self.parameters)
+        for index, parameter in enumerate(self.parameters):
+            if parameter.changed:
+                parameter.changed = False
+                distance = number_of_lines - index
+                frame.append("\033[{}A\r{}\033[{}B\r".format(distance, parameter, distance))
+        return "".join(frame)
 
+    def run(self):
         while True:
-            if not first_run:
-                sys.stdout.write("\033[F"*14)
-
-            print("\n ---- AMP-O-METER ---- \033[K")
-            print(self.time_elapsed)
-            print(self.number_of_ticks)
-            print(self.ticks_per_second)
-            print(self.number_of_positive_ticks)
-            print(self.number_of_negative_ticks)
-            print(self.avg_current)
-            print(self.total_charge)
-            print(self.resistor_value)
-            print(self.charge_mc)
-            print(self.std_deviation_current)
-            print(self.file_name)
-            print(self.ma_period)
-
-            first_run = False
-            sleep(0.1)
-            # print("---------------------------------------------------------------------")
-
+            if not self.headless:
+                frame = self.render()
+                if frame:
+                    sys.stdout.write(frame)
+                    sys.stdout.flush()
+
+            sleep(1 / self.refresh_rate)
+
+
+# Rows shown for each channel by the multi channel UIs
+CHANNEL_ROWS = [
+    ("number_of_ticks",          "Total ticks"),
+    ("ticks_per_second",         "Ticks per second"),
+    ("number_of_positive_ticks", "Total positive ticks"),
+    ("number_of_negative_ticks", "Total negative ticks"),
+    ("avg_current",              "Avg current (mA)"),
+    ("instant_current",          "Instant current (mA)"),
+    ("total_charge",             "Total charge (mC)"),
+    ("std_deviation_current",    "Std deviation (mA)"),
+    ("resistor_value",           "Resistor value"),
+    ("charge_mc",                "mC per tick"),
+    ("history_queue",            "History rows waiting"),
+]
+
+
+class MultiChannelTerminalUI(TerminalUI):
+    COLUMN_WIDTH = 14
+
+    def __init__(self, channel_names, refresh_rate=10, headless=None):
+        self.setup_screen(refresh_rate, headless)
+
+        self.time_elapsed = self.Parameter("Time elapsed")
+        self.overruns     = self.Parameter("Missed ticks (buffer)")
+        channels = self.Parameter("Channel")
+        channels.set(self.format_row(channel_names))
+
+        self.rows = {}
+        self.parameters = [self.time_elapsed, channels]
+        for key, description in CHANNEL_ROWS:
+            self.rows[key] = self.Parameter(description)
+            self.parameters.append(self.rows[key])
+        self.parameters.append(self.overruns)
+
+    def format_row(self, values):
+        return "".join("{: <{}}".format(str(value), self.COLUMN_WIDTH) for value in values)
+
+    def set_row(self, key, values):
+        self.rows[key].set(self.format_row(values))
+
+
+def import_tk_gui():
+    # tkinter takes a while to import on a Pi and may not even be installed on
+    # headless ones, so it is only loaded when the Tk UI is used
+    try:
+        import tk_gui
+    except ImportError:
+        print("\ntkinter is not available, run this script with the flag --ui_type terminal or off\n")
+        raise
+    return tk_gui
+
+
+def parse_history_option(create_csv):
+    # maps the --csv option to Counter's create_csv and history_format
+    if create_csv == "bin":
+        return True, "bin"
+    elif create_csv == "on":
+        return True, "csv"
+    else:
+        return False, "csv"
+
+
+def load_calibration(file_name):
+    # Reads a file saved by calibrator.py and returns {sensor id: (a, b)},
+    # the coefficients of real_current = a * ticks_per_second + b
+    with open(file_name, 'r') as calibration_file:
+        data = json.load(calibration_file)
+
+    calibrations = {}
+    for sensor in data["sensor_list"]:
+        regression_data = sensor["regression_data"]
+        calibrations[str(sensor["id"])] = (regression_data["a"], regression_data["b"])
+    return calibrations
+
+
+def format_moving_average(counter):
+    if counter.ma_mode == "time":
+        return "last {:g} s".format(counter.ma_seconds)
+    elif counter.ma_mode == "ema":
+        return "EMA, {:g} s".format(counter.ma_seconds)
+    return "{} ticks".format(counter.ma_period)
+
+
+def format_charge_mC(counter):
+    if counter.calibration is None:
+        return "{:.4g} mC".format(counter.charge_mC)
+    return "{:.4g} mC (cal.)".format(counter.charge_mC)
+
+
+class Channel:
+    # One LTC4150 connected to the Pi: its pins and its counter
+    def __init__(self, index, name, interrupt_pin, polarity_pin, counter):
+        self.index = index
+        self.name = name
+        self.interrupt_pin = interrupt_pin
+        self.polarity_pin = polarity_pin
+        self.counter = counter
+        self.did_tick = False
 
-class Controller:
-    def __init__(self, polarity_pin, interrupt_pin, vio_pin, create_csv=False, resistor_value=4.7, ui_type="gui", ma_period=0):
-        if create_csv == "on":
-            create_csv = True
+    def add_tick(self, direction, instant):
+        if not self.did_tick:
+            self.counter.start = instant
+            self.did_tick = True
         else:
-            create_csv = False
+            self.counter.add_tick(instant, direction)
 
+
+class Controller:
+    # The options shared with MultiChannelController (std_window, source,
+    # daemon, ...) are passed by keyword to setup(), which lists them with
+    # their defaults
+    def __init__(self, polarity_pin, interrupt_pin, vio_pin, create_csv=False, resistor_value=4.7, ui_type="gui", ma_period=0,
+                 calibration=None, **options):
         self.resistor_value = resistor_value
         self.polarity_pin = polarity_pin
         self.interrupt_pin = interrupt_pin
-        self.vio_pin = vio_pin
-        self.ui_type = ui_type
-        self.ma_period = ma_period
-        self.did_tick = False
+        self.setup(vio_pin, create_csv=create_csv, ui_type=ui_type, ma_period=ma_period, **options)
 
-        self.counter = Counter(create_csv, resistor_value, self.ma_period)
+        self.counter = self.create_channel("", interrupt_pin, polarity_pin, resistor_value, calibration).counter
 
         if self.ui_type is None or self.ui_type == "off":
             self.ui_type = None
             # print("--- UI DISABLED ---")
             return
         elif self.ui_type == "terminal":
-            self.gui = TerminalUI()
+            self.gui = TerminalUI(self.ui_fps)
         elif self.ui_type == "gui":
+            tk_gui = import_tk_gui()
             try:
-                self.gui = TkGui()
-                self.gui.reset_button.bind("<Button>", self.reset)
-            except  TclError:
+                self.gui = tk_gui.TkGui()
+                self.gui.reset_button.bind("<Button>", lambda _: self.reset())
+            except tk_gui.TclError:
                 # traceback.print_exc()
                 print("\nAre you running this via shh? Either enable remote X server or run this script with the flag --terminal\n")
+                raise
         else:
             print(" --- ERROR: no ui type specified! ---")
             raise Exception
@@ -280,85 +845,505 @@ class Controller:
         if self.ui_type is not None:
             self.gui.file_name.set("Waiting for first tick...")
             self.gui.resistor_value.set("{:.3g} ohms".format(resistor_value))
-            self.gui.charge_mc.set("{:.4g} mC".format(Tick.CHARGE_mC))
-            self.gui.ma_period.set("{} ticks".format(ma_period))
+            self.gui.charge_mc.set(format_charge_mC(self.counter))
+            self.gui.ma_period.set(format_moving_average(self.counter))
+
+    def setup(self, vio_pin, create_csv=False, ui_type="gui", ma_period=0, ma_mode="ticks", ma_seconds=10.0,
+              std_window=0, max_ticks=0, spill_ticks="off", csv_flush_rows=256, csv_flush_interval=1.0,
+              buffer_size=4096, ingest_interval=0.01, ui_fps=10, source=None, telemetry_port=None,
+              telemetry_rate=2.0, rollup="off", instrumentation="off", stats_interval=60.0, rotate_size=0,
+              rotate_interval=0, compress="on", daemon=False, shm_feed=None):
+        # In daemon mode there is no UI, run() only returns once stop() is
+        # called, the number of ticks kept in memory is bounded and a summary
+        # is written when the controller is closed
+        self.daemon = daemon
+        self.stopping = threading.Event()
+        if daemon:
+            ui_type = "off"
+            if not max_ticks:
+                max_ticks = DAEMON_MAX_TICKS
+
+        # state shared by every channel of the controller
+        create_csv, history_format = parse_history_option(create_csv)
+        self.counter_options = {
+            "create_csv": create_csv,
+            "ma_period": ma_period,
+            "ma_mode": ma_mode,
+            "ma_seconds": ma_seconds,
+            "std_window": std_window,
+            "max_ticks": max_ticks,
+            "spill_ticks": spill_ticks == "on",
+            "csv_flush_rows": csv_flush_rows,
+            "csv_flush_interval": csv_flush_interval,
+            "history_format": history_format,
+            "rollup": rollup == "on",
+            # rotate_size is in MB
+            "rotate_bytes": int(rotate_size * 1e6),
+            "rotate_seconds": rotate_interval,
+            "compress_history": compress == "on",
+        }
+
+        self.vio_pin = vio_pin
+        self.ui_type = ui_type
+        self.ma_period = ma_period
+        self.channels = []
+
+        # where the ticks come from: the LTC4150 interrupt pins by default, see
+        # tick_sources.py for the simulated and replay sources
+        if source is None:
+            source = GpioTickSource()
+        self.source = source
+
+        # the callbacks store monotonic timestamps, converted to wall clock
+        # time with a fixed offset when the ticks are ingested, so every
+        # channel is measured against the same clock
+        self.tick_buffer = TickRingBuffer(buffer_size)
+        self.ingest_interval = ingest_interval
+        self.clock_offset = time() - monotonic()
+        self.ingest_thread = None
+        self.ingesting = False
+
+        # called from the ingestion thread with every batch of
+        # (monotonic instant, polarity, channel index) ticks
+        self.tick_listeners = []
+        # (monotonic instant, threading.Event) of a reset waiting to be
+        # applied by the ingestion thread
+        self.reset_request = None
+
+        # optional measurements of the ingestion itself, see instrumentation.py;
+        # created in run() once the channels are known
+        self.instrumented = instrumentation == "on"
+        self.stats_interval = stats_interval
+        self.instrumentation = None
+
+        # name of the optional shared memory segment with the readings, see shm_feed.py
+        self.shm_feed_name = shm_feed
+        self.shm_feed = None
+
+        # optional TCP server publishing the readings, see telemetry.py
+        self.telemetry_port = telemetry_port
+        self.telemetry_rate = telemetry_rate
+        self.telemetry = None
+
+        # the UI is refreshed from a snapshot of the counter at a fixed rate,
+        # however fast the ticks arrive
+        self.ui_fps = ui_fps
+        self.last_snapshot = None
+        self.last_time_elapsed = None
+        self.startup_time = None
+
+    def create_channel(self, name, interrupt_pin, polarity_pin, resistor_value, calibration=None):
+        counter = Counter(resistor_value=resistor_value, name=name, calibration=calibration, **self.counter_options)
+        channel = Channel(len(self.channels), name, interrupt_pin, polarity_pin, counter)
+        self.channels.append(channel)
+        return channel
 
-            self.update_time_thread = Thread(target=self.update_time_elapsed, daemon=True)
-            self.update_time_thread.start()
+    @property
+    def did_tick(self):
+        return self.channels[0].did_tick
 
     def clean_gpio(self):
-        GPIO.cleanup()
+        cleanup_gpio()
+
+    def close(self):
+        self.source.stop()
+
+        if self.ingest_thread is not None:
+            self.ingesting = False
+            self.ingest_thread.join()
+            self.ingest_thread = None
+            self.ingest_batch()
+
+        self.stop_telemetry()
+        self.stop_shm_feed()
 
-    def reset(self, _):
-        self.reset()
+        if self.instrumentation is not None:
+            self.instrumentation.dump(self.tick_buffer.overruns)
+
+        for channel in self.channels:
+            channel.counter.close()
+
+        if self.daemon:
+            self.write_summary()
 
     def reset(self):
-        self.counter.reset()
+        # While the ingestion thread runs the counters are only modified by
+        # it: the reset is handed over and applied between two batches (see
+        # ingest_batch), and this waits until it has been. If the thread is
+        # gone nothing else touches the counters, so it is applied here.
+        if self.ingest_thread is None:
+            self.reset_counters()
+        else:
+            applied = threading.Event()
+            self.reset_request = (monotonic(), applied)
+            while not applied.wait(0.1):
+                if not self.ingest_thread.is_alive():
+                    if self.reset_request is not None:
+                        self.reset_request = None
+                        self.reset_counters()
+                    break
 
         if self.ui_type is not None:
-            self.gui.file_name.set("Waiting for first tick...")
-            self.gui.number_of_ticks.set("")
-            self.gui.total_charge.set("")
-            self.gui.avg_current.set("")
-            self.gui.std_deviation_current.set("")
+            self.last_snapshot = None
+            self.reset_gui()
+
+    def reset_counters(self):
+        for channel in self.channels:
+            channel.counter.reset()
+        if self.instrumentation is not None:
+            self.instrumentation.restart()
+
+        # an empty batch, for the listeners also following the counters
+        for listener in self.tick_listeners:
+            listener([])
+
+    def reset_gui(self):
+        self.gui.file_name.set("Waiting for first tick...")
+        self.gui.number_of_ticks.set("")
+        self.gui.total_charge.set("")
+        self.gui.avg_current.set("")
+        self.gui.instant_current.set("")
+        self.gui.std_deviation_current.set("")
 
     def run(self):
+        self.start_instrumentation()
         self.setup_probe()
+        # before the ingestion thread, so the feed gets every tick
+        self.start_shm_feed()
+        self.start_ingestion()
+        self.start_telemetry()
+        self.startup_time = monotonic() - STARTED
+        print("--- Measuring {:.0f} ms after startup".format(self.startup_time * 1000))
 
         if self.ui_type is not None:
+            self.start_refresh()
             self.gui.run()
+        elif self.daemon:
+            self.serve()
+
+    def serve(self):
+        # daemon mode: runs until stop() is called (on SIGTERM or Ctrl+C, see
+        # __main__), printing a status line every DAEMON_STATUS_INTERVAL seconds
+        while not self.stopping.wait(DAEMON_STATUS_INTERVAL):
+            self.print_status()
+
+    def stop(self):
+        self.stopping.set()
+
+    def print_status(self):
+        for channel in self.channels:
+            snapshot = channel.counter.snapshot()
+            total_charge = (snapshot.number_of_positive_ticks - snapshot.number_of_negative_ticks) * \
+                channel.counter.charge_mC
+            print("--- {} {}: {} ticks, {:.2f} mC, {:.3f} mA, {} history rows dropped".format(
+                strftime('%Y-%m-%d %H:%M:%S', localtime(time())), channel.name or "counter",
+                snapshot.number_of_ticks, total_charge, snapshot.avg_current, snapshot.history_dropped_rows))
+        print("--- {} ticks missed (buffer)".format(self.tick_buffer.overruns))
+        sys.stdout.flush()
+
+    def summary(self):
+        end = time()
+        channels = []
+        for channel in self.channels:
+            counter = channel.counter
+            charge = counter.total_charge
+            duration = end - counter.start
+            channels.append({
+                "name": channel.name,
+                "start": counter.start,
+                "duration": duration,
+                "number_of_ticks": counter.number_of_ticks,
+                "number_of_positive_ticks": counter.number_of_positive_ticks,
+                "number_of_negative_ticks": counter.number_of_negative_ticks,
+                "charge": charge,
+                "avg_current": charge / duration if duration > 0 and counter.number_of_ticks else 0.0,
+                "charge_mC": counter.charge_mC,
+                "history_files": counter.history_segments,
+                # every file of the run, the counters are closed by now
+                "history_dropped_rows": counter.closed_history_dropped_rows + counter.history_dropped_rows,
+            })
+        return {"end": end, "overruns": self.tick_buffer.overruns, "channels": channels}
+
+    def write_summary(self):
+        if not os.path.exists('history'):
+            os.makedirs('history')
+        file_name = "history/summary_{}.json".format(
+            strftime('%Y-%m-%d %H:%M:%S', localtime(time())).replace(' ', '_'))
+
+        summary = self.summary()
+        with open(file_name, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=4)
+
+        for channel in summary["channels"]:
+            print("--- {}: {} ticks in {:.0f} s, {:.2f} mC, {:.4f} mA on average".format(
+                channel["name"] or "counter", channel["number_of_ticks"], channel["duration"], channel["charge"],
+                channel["avg_current"]))
+        print("--- Summary written to {}".format(file_name))
+
+    def add_tick(self, direction=Tick.DISCHARGING, instant=None):
+        if instant is None:
+            instant = time()
+        self.channels[0].add_tick(direction, instant)
+        self.channels[0].counter.publish()
 
-    def add_tick(self, direction=Tick.DISCHARGING):
-        if not self.did_tick:
-            self.counter.start = time()
-            self.update_gui()
-            self.did_tick = True
+    def start_instrumentation(self):
+        if not self.instrumented:
+            return
+
+        from instrumentation import Instrumentation
+        self.instrumentation = Instrumentation([channel.name for channel in self.channels],
+                                               dump_interval=self.stats_interval)
+        if self.ui_type == "terminal":
+            self.gui.add_instrumentation()
+        print("--- Pipeline statistics written to {}".format(self.instrumentation.stats_file))
+
+    def start_telemetry(self):
+        if self.telemetry_port is None:
+            return
+
+        # asyncio is only imported when the server is enabled
+        from telemetry import TelemetryServer
+        self.telemetry = TelemetryServer(self, self.telemetry_port, rate=self.telemetry_rate)
+        self.telemetry.start()
+        print("--- Telemetry server listening on port {}".format(self.telemetry.port))
+
+    def stop_telemetry(self):
+        if self.telemetry is not None:
+            self.telemetry.stop()
+            self.telemetry = None
+
+    def start_shm_feed(self):
+        if self.shm_feed_name is None:
+            return
+
+        from shm_feed import ShmFeedWriter
+        self.shm_feed = ShmFeedWriter(self, self.shm_feed_name)
+        self.shm_feed.start()
+        print("--- Live readings in shared memory segment {}".format(self.shm_feed_name))
+
+    def stop_shm_feed(self):
+        if self.shm_feed is not None:
+            self.shm_feed.close()
+            self.shm_feed = None
+
+    def start_ingestion(self):
+        self.ingesting = True
+        self.ingest_thread = Thread(target=self.ingest, daemon=True)
+        self.ingest_thread.start()
+
+    def ingest(self):
+        while self.ingesting:
+            sleep(self.ingest_interval)
+            # an error in a counter, history writer or listener loses the
+            # rest of its batch, not the thread that all the counters need
+            try:
+                self.ingest_batch()
+                # on every cycle, so the stats file is still written when no ticks come in
+                if self.instrumentation is not None:
+                    self.instrumentation.maybe_dump(self.tick_buffer.overruns)
+            except Exception:
+                print("\n --- ERROR while ingesting ticks: ---")
+                traceback.print_exc()
+
+    def ingest_batch(self):
+        batch = self.tick_buffer.drain()
+
+        reset_request = self.reset_request
+        if reset_request is not None:
+            # the ticks of the batch that arrived before the reset still
+            # belong to the run being reset (and its history file)
+            self.reset_request = None
+            requested, applied = reset_request
+            try:
+                self.ingest_ticks([tick for tick in batch if tick[0] < requested])
+                self.reset_counters()
+            finally:
+                # reset() must not wait forever on a failed reset
+                applied.set()
+            batch = [tick for tick in batch if tick[0] >= requested]
+
+        self.ingest_ticks(batch)
+
+    def ingest_ticks(self, batch):
+        if not batch:
+            return
+
+        channels = self.channels
+        clock_offset = self.clock_offset
+        if self.instrumentation is None:
+            for instant, polarity, index in batch:
+                if polarity:
+                    channels[index].add_tick(Tick.RECHARGING, instant + clock_offset)
+                else:
+                    channels[index].add_tick(Tick.DISCHARGING, instant + clock_offset)
         else:
-            instant = time()
-            self.counter.add_tick(instant, direction)
+            self.ingest_instrumented(batch)
+
+        for channel in channels:
+            channel.counter.publish()
+
+        for listener in self.tick_listeners:
+            listener(batch)
+
+    def ingest_instrumented(self, batch):
+        # same as the loop of ingest_batch, timing every tick; kept separate
+        # so that the uninstrumented loop doesn't pay for it
+        channels = self.channels
+        clock_offset = self.clock_offset
+        instrumentation = self.instrumentation
+        ingested = monotonic()
+        instrumentation.add_batch(len(batch))
+
+        for instant, polarity, index in batch:
+            started = perf_counter()
+            if polarity:
+                channels[index].add_tick(Tick.RECHARGING, instant + clock_offset)
+            else:
+                channels[index].add_tick(Tick.DISCHARGING, instant + clock_offset)
+            instrumentation.add_tick(index, instant, ingested - instant, perf_counter() - started)
+
+    def update_instrumentation(self):
+        if self.instrumentation is None or self.ui_type != "terminal":
+            return
+
+        from instrumentation import format_latency
+        instrumentation = self.instrumentation
+        self.gui.tick_processing.set(format_latency(instrumentation.processing))
+        self.gui.edge_delay.set(format_latency(instrumentation.edge_delay))
+        self.gui.suspicious_intervals.set("{} short, {} long, largest batch {}".format(
+            instrumentation.short_intervals, instrumentation.long_intervals, instrumentation.max_batch))
+
+    def start_refresh(self):
+        if self.ui_type == "gui":
+            # Tk variables must only be touched from the Tk thread
+            self.gui.root.after(0, self.refresh_tk)
+        else:
+            Thread(target=self.refresh_loop, daemon=True).start()
+
+    def refresh_tk(self):
+        self.update_gui()
+        self.gui.root.after(int(1000 / self.ui_fps), self.refresh_tk)
+
+    def refresh_loop(self):
+        while True:
             self.update_gui()
+            sleep(1 / self.ui_fps)
 
     def update_gui(self):
-        if self.ui_type is not None:
-            self.gui.number_of_ticks.set(self.counter.number_of_ticks)
-            self.gui.ticks_per_second.set("{:3.2f}".format(self.counter.ticks_per_second))
-            self.gui.number_of_positive_ticks.set(self.counter.number_of_positive_ticks)
-            self.gui.number_of_negative_ticks.set(self.counter.number_of_negative_ticks)
-            self.gui.total_charge.set("{:7.2f}".format(self.counter.accumulated_charge))
-            self.gui.avg_current.set("{:5.3f}".format(self.counter.avg_current))
-            self.gui.std_deviation_current.set("{:5.3f}".format(self.counter.std_deviation_current))
-            self.gui.file_name.set(self.counter.file_name)
-
-    def update_time_elapsed(self):
-        while True:
-            hours, rem = divmod(time() - self.counter.start, 3600)
-            minutes, seconds = divmod(rem, 60)
-            self.gui.time_elapsed.set("{:0>2}:{:0>2}:{:02.0f}".format(int(hours), int(minutes), seconds))
-            sleep(1)
+        if self.ui_type is None:
+            return
+
+        snapshot = self.counter.snapshot()
+        self.update_time_elapsed(snapshot.start)
+        self.update_instrumentation()
+        if snapshot == self.last_snapshot:
+            return
+        self.last_snapshot = snapshot
+
+        self.gui.number_of_ticks.set(snapshot.number_of_ticks)
+        self.gui.ticks_per_second.set("{:3.2f}".format(snapshot.ticks_per_second))
+        self.gui.number_of_positive_ticks.set(snapshot.number_of_positive_ticks)
+        self.gui.number_of_negative_ticks.set(snapshot.number_of_negative_ticks)
+        self.gui.total_charge.set("{:7.2f}".format(snapshot.accumulated_charge))
+        self.gui.avg_current.set("{:5.3f}".format(snapshot.avg_current))
+        self.gui.instant_current.set("{:5.3f}".format(snapshot.instant_current))
+        self.gui.std_deviation_current.set("{:5.3f}".format(snapshot.std_deviation_current))
+        if self.did_tick:
+            self.gui.file_name.set(snapshot.file_name)
+        self.gui.history_queue.set("{} rows waiting, {} dropped".format(snapshot.history_queue_depth,
+                                                                        snapshot.history_dropped_rows))
+        self.gui.overruns.set(self.tick_buffer.overruns)
+
+    def update_time_elapsed(self, start):
+        elapsed = int(time() - start)
+        if elapsed == self.last_time_elapsed:
+            return
+        self.last_time_elapsed = elapsed
+
+        hours, rem = divmod(elapsed, 3600)
+        minutes, seconds = divmod(rem, 60)
+        self.gui.time_elapsed.set("{:0>2}:{:0>2}:{:02.0f}".format(int(hours), int(minutes), seconds))
 
     def setup_probe(self):
-        GPIO.setmode(GPIO.BCM)
+        self.source.start(self)
+
+
+class MultiChannelController(Controller):
+    # Several sensors in one process: one tick buffer and ingestion thread for
+    # all of them, and one UI showing the channels side by side. `channels` is
+    # a list of dicts with the keys "name", "int_pin", "pol_pin" and
+    # "resistor_value" (optional, defaults to resistor_value). `calibrations`
+    # maps sensor ids to (a, b) calibrations (see load_calibration); a channel
+    # uses the one of its "sensor_id" key, or of its name. The other options
+    # are those of Controller.setup().
+    def __init__(self, channels, vio_pin, resistor_value=4.7, calibrations=None, **options):
+        if not 0 < len(channels) <= 8:
+            print(" --- ERROR: between 1 and 8 channels are supported! ---")
+            raise Exception
 
-        GPIO.setup(self.interrupt_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(self.polarity_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+        self.setup(vio_pin, **options)
 
-        GPIO.setup(self.vio_pin, GPIO.OUT)
-        GPIO.output(self.vio_pin, GPIO.HIGH)
+        if calibrations is None:
+            calibrations = {}
 
-        GPIO.add_event_detect(self.interrupt_pin, GPIO.FALLING, callback=self.probe_callback)
+        for index, channel in enumerate(channels):
+            name = channel.get("name", str(index))
+            self.create_channel(name, channel["int_pin"], channel["pol_pin"],
+                                channel.get("resistor_value", resistor_value),
+                                calibrations.get(channel.get("sensor_id", name)))
 
-    def probe_callback(self, _):
-        try:
-            polarity = GPIO.input(self.polarity_pin)
-            if polarity:
-                polarity = Tick.RECHARGING
-            else:
-                polarity = Tick.DISCHARGING
+        # the first channel stands in for single channel code using .counter
+        self.counter = self.channels[0].counter
+        channel_names = [channel.name for channel in self.channels]
 
-            self.add_tick(polarity)
-        except:
-            print("------ ERROR ------------------")
-            print("Polarity pin: {}".format(self.polarity_pin))
+        if self.ui_type is None or self.ui_type == "off":
+            self.ui_type = None
+            return
+        elif self.ui_type == "terminal":
+            self.gui = MultiChannelTerminalUI(channel_names, self.ui_fps)
+        elif self.ui_type == "gui":
+            tk_gui = import_tk_gui()
+            try:
+                self.gui = tk_gui.MultiChannelTkGui(channel_names, CHANNEL_ROWS)
+                self.gui.reset_button.bind("<Button>", lambda _: self.reset())
+            except tk_gui.TclError:
+                print("\nAre you running this via shh? Either enable remote X server or run this script with the flag --terminal\n")
+                raise
+        else:
+            print(" --- ERROR: no ui type specified! ---")
+            raise Exception
+
+        if self.ui_type is not None:
+            self.gui.set_row("resistor_value", ["{:.3g} ohms".format(channel.counter.resistor_value)
+                                                for channel in self.channels])
+            self.gui.set_row("charge_mc", [format_charge_mC(channel.counter) for channel in self.channels])
+
+    def reset_gui(self):
+        for key in ("number_of_ticks", "total_charge", "avg_current", "instant_current", "std_deviation_current"):
+            self.gui.set_row(key, ["" for _ in self.channels])
+
+    def update_gui(self):
+        if self.ui_type is None:
+            return
+
+        snapshots = [channel.counter.snapshot() for channel in self.channels]
+        self.update_time_elapsed(min(snapshot.start for snapshot in snapshots))
+        self.update_instrumentation()
+        if snapshots == self.last_snapshot:
+            return
+        self.last_snapshot = snapshots
+
+        self.gui.set_row("number_of_ticks", [snapshot.number_of_ticks for snapshot in snapshots])
+        self.gui.set_row("ticks_per_second", ["{:3.2f}".format(snapshot.ticks_per_second) for snapshot in snapshots])
+        self.gui.set_row("number_of_positive_ticks", [snapshot.number_of_positive_ticks for snapshot in snapshots])
+        self.gui.set_row("number_of_negative_ticks", [snapshot.number_of_negative_ticks for snapshot in snapshots])
+        self.gui.set_row("avg_current", ["{:5.3f}".format(snapshot.avg_current) for snapshot in snapshots])
+        self.gui.set_row("instant_current", ["{:5.3f}".format(snapshot.instant_current) for snapshot in snapshots])
+        self.gui.set_row("total_charge", ["{:7.2f}".format(snapshot.accumulated_charge) for snapshot in snapshots])
+        self.gui.set_row("std_deviation_current", ["{:5.3f}".format(snapshot.std_deviation_current)
+                                                   for snapshot in snapshots])
+        self.gui.set_row("history_queue", [snapshot.history_queue_depth for snapshot in snapshots])
+        self.gui.overruns.set(self.tick_buffer.overruns)
 
 
 if __name__ == "__main__":
@@ -372,7 +1357,36 @@ if __name__ == "__main__":
     parser.add_argument("--int_pin")
     parser.add_argument("--vio_pin")
     parser.add_argument("--ma_period")
+    parser.add_argument("--ma_mode")
+    parser.add_argument("--ma_seconds")
     parser.add_argument("--ui_type")
+    parser.add_argument("--std_window")
+    parser.add_argument("--max_ticks")
+    parser.add_argument("--spill_ticks")
+    parser.add_argument("--csv_flush_rows")
+    parser.add_argument("--csv_flush_interval")
+    parser.add_argument("--buffer_size")
+    parser.add_argument("--ui_fps")
+    parser.add_argument("--channels")
+    parser.add_argument("--source")
+    parser.add_argument("--sim_current")
+    parser.add_argument("--sim_recharge")
+    parser.add_argument("--sim_jitter")
+    parser.add_argument("--replay_file", action="append")
+    parser.add_argument("--replay_speed")
+    parser.add_argument("--gpio_chip")
+    parser.add_argument("--calibration")
+    parser.add_argument("--sensor_id")
+    parser.add_argument("--telemetry_port")
+    parser.add_argument("--telemetry_rate")
+    parser.add_argument("--rollup")
+    parser.add_argument("--instrumentation")
+    parser.add_argument("--stats_interval")
+    parser.add_argument("--rotate_size")
+    parser.add_argument("--rotate_interval")
+    parser.add_argument("--compress")
+    parser.add_argument("--daemon")
+    parser.add_argument("--shm_feed")
     try:
         args = parser.parse_args()
     except:
@@ -394,6 +1408,29 @@ if __name__ == "__main__":
             "ui_type": "terminal"
         }
 
+    # options added after the first release may be missing from older config files
+    config.setdefault("std_window", 0)
+    config.setdefault("max_ticks", 0)
+    config.setdefault("spill_ticks", "off")
+    config.setdefault("csv_flush_rows", 256)
+    config.setdefault("csv_flush_interval", 1.0)
+    config.setdefault("buffer_size", 4096)
+    config.setdefault("ui_fps", 10)
+    config.setdefault("channels", None)
+    config.setdefault("calibration", None)
+    config.setdefault("sensor_id", None)
+    config.setdefault("telemetry_port", None)
+    config.setdefault("telemetry_rate", 2.0)
+    config.setdefault("rollup", "off")
+    config.setdefault("ma_mode", "ticks")
+    config.setdefault("ma_seconds", 10.0)
+    config.setdefault("instrumentation", "off")
+    config.setdefault("stats_interval", 60.0)
+    config.setdefault("rotate_size", 0)
+    config.setdefault("rotate_interval", 0)
+    config.setdefault("compress", "on")
+    config.setdefault("shm_feed", None)
+
     if args.resistor is not None:
         config["resistor_value"] = float(args.resistor)
 
@@ -409,11 +1446,113 @@ if __name__ == "__main__":
     if args.ma_period is not None:
         config["ma_period"] = int(args.ma_period)
 
+    if args.ma_mode is not None:
+        if args.ma_mode == "ticks" or args.ma_mode == "time" or args.ma_mode == "ema":
+            config["ma_mode"] = args.ma_mode
+        else:
+            print("Unknown value of option '--ma_mode'. Please choose either 'ticks', 'time' or 'ema' (without quotes)")
+            raise Exception
+
+    if args.ma_seconds is not None:
+        config["ma_seconds"] = float(args.ma_seconds)
+
+    if config["ma_mode"] != "ticks" and config["ma_seconds"] <= 0:
+        print("Option '--ma_seconds' must be positive with '--ma_mode {}'".format(config["ma_mode"]))
+        raise Exception
+
+    if args.std_window is not None:
+        config["std_window"] = int(args.std_window)
+
+    if args.max_ticks is not None:
+        config["max_ticks"] = int(args.max_ticks)
+
+    if args.spill_ticks is not None:
+        if args.spill_ticks == "on" or args.spill_ticks == "off":
+            config["spill_ticks"] = args.spill_ticks
+        else:
+            print("Unknown value of option '--spill_ticks'. Please choose either 'on' or 'off' (without quotes)")
+            raise Exception
+
+    if args.rollup is not None:
+        if args.rollup == "on" or args.rollup == "off":
+            config["rollup"] = args.rollup
+        else:
+            print("Unknown value of option '--rollup'. Please choose either 'on' or 'off' (without quotes)")
+            raise Exception
+
+    if args.instrumentation is not None:
+        if args.instrumentation == "on" or args.instrumentation == "off":
+            config["instrumentation"] = args.instrumentation
+        else:
+            print("Unknown value of option '--instrumentation'. Please choose either 'on' or 'off' (without quotes)")
+            raise Exception
+
+    if args.stats_interval is not None:
+        config["stats_interval"] = float(args.stats_interval)
+
+    if args.rotate_size is not None:
+        config["rotate_size"] = float(args.rotate_size)
+
+    if args.rotate_interval is not None:
+        config["rotate_interval"] = parse_duration(args.rotate_interval)
+
+    if args.compress is not None:
+        if args.compress == "on" or args.compress == "off":
+            config["compress"] = args.compress
+        else:
+            print("Unknown value of option '--compress'. Please choose either 'on' or 'off' (without quotes)")
+            raise Exception
+
+    if args.csv_flush_rows is not None:
+        config["csv_flush_rows"] = int(args.csv_flush_rows)
+
+    if args.csv_flush_interval is not None:
+        config["csv_flush_interval"] = float(args.csv_flush_interval)
+
+    if args.buffer_size is not None:
+        config["buffer_size"] = int(args.buffer_size)
+
+    if args.ui_fps is not None:
+        config["ui_fps"] = float(args.ui_fps)
+
+    if args.channels is not None:
+        if args.channels == "off":
+            config["channels"] = None
+        else:
+            with open(args.channels, 'r') as channels_file:
+                config["channels"] = json.load(channels_file)
+
+    if args.calibration is not None:
+        if args.calibration == "off":
+            config["calibration"] = None
+        else:
+            config["calibration"] = args.calibration
+
+    if args.sensor_id is not None:
+        config["sensor_id"] = args.sensor_id
+
+    if args.telemetry_port is not None:
+        if args.telemetry_port == "off":
+            config["telemetry_port"] = None
+        else:
+            config["telemetry_port"] = int(args.telemetry_port)
+
+    if args.shm_feed is not None:
+        if args.shm_feed == "off":
+            config["shm_feed"] = None
+        elif args.shm_feed == "on":
+            config["shm_feed"] = "amp_o_meter"
+        else:
+            config["shm_feed"] = args.shm_feed
+
+    if args.telemetry_rate is not None:
+        config["telemetry_rate"] = float(args.telemetry_rate)
+
     if args.csv is not None:
-        if args.csv == "on" or args.csv == "off":
+        if args.csv == "on" or args.csv == "off" or args.csv == "bin":
             config["enable_csv"] = args.csv
         else:
-            print("Unknown value of option '--csv'. Please choose either 'on' or 'off' (without quotes)")
+            print("Unknown value of option '--csv'. Please choose either 'on', 'bin' or 'off' (without quotes)")
             raise Exception
 
     if args.ui_type is not None:
@@ -426,23 +1565,104 @@ if __name__ == "__main__":
     with open('config.json', 'w') as config_file:
         json.dump(config, config_file)
 
-    print("--- Run config: \n       resistor value: {}\n       csv: {}\n       ui_type: {}\n"
-          "       pol_pin: {}\n       int_pin: {}\n       vio_pin: {}\n       ma_period: {}".format(config["resistor_value"],
-                                                                                config["enable_csv"],
-                                                                                config["ui_type"],
-                                                                                config["pol_pin"],
-                                                                                config["int_pin"],
-                                                                                config["vio_pin"],
-                                                                                config["ma_period"]))
+    # daemon mode is chosen for each run too: a service shouldn't turn the
+    # next interactive run into a daemon
+    daemon = args.daemon == "on"
+    if args.daemon is not None and args.daemon != "on" and args.daemon != "off":
+        print("Unknown value of option '--daemon'. Please choose either 'on' or 'off' (without quotes)")
+        raise Exception
+    if daemon and not config["rotate_size"] and not config["rotate_interval"]:
+        # a history file per day unless told otherwise
+        config["rotate_interval"] = DAEMON_ROTATE_INTERVAL
+
+    # the tick source is chosen for each run and not saved in config.json
+    if args.source is None or args.source == "gpio":
+        source = GpioTickSource()
+    elif args.source == "gpiochip":
+        source = GpioChipTickSource(args.gpio_chip or "/dev/gpiochip0")
+    elif args.source == "sim":
+        source = SyntheticTickSource(current_profile=args.sim_current or 5.0,
+                                     recharge_ratio=float(args.sim_recharge or 0),
+                                     jitter=float(args.sim_jitter or 0))
+    elif args.source == "replay":
+        if not args.replay_file:
+            print("Option '--source replay' needs at least one '--replay_file'")
+            raise Exception
+        source = ReplayTickSource(args.replay_file, speed=float(args.replay_speed or 1))
+    else:
+        print("Unknown value of option '--source'. Please choose either 'gpio', 'gpiochip', 'sim' or 'replay' (without quotes)")
+        raise Exception
+
+    calibrations = {}
+    calibration = None
+    if config["calibration"] is not None:
+        calibrations = load_calibration(config["calibration"])
+        if config["channels"] is None:
+            if config["sensor_id"] is not None:
+                sensor_id = config["sensor_id"]
+            elif len(calibrations) == 1:
+                sensor_id = next(iter(calibrations))
+            else:
+                print("Calibration file '{}' has several sensors, choose one with '--sensor_id' ({})".format(
+                      config["calibration"], ", ".join(calibrations)))
+                raise Exception
+
+            if sensor_id not in calibrations:
+                print("Sensor '{}' not found in calibration file '{}'".format(sensor_id, config["calibration"]))
+                raise Exception
+            calibration = calibrations[sensor_id]
+
+    print("--- Run config:")
+    for key, value in config.items():
+        print("       {}: {}".format(key, value))
+
+    options = {
+        "create_csv": config["enable_csv"],
+        "resistor_value": config["resistor_value"],
+        "ui_type": config["ui_type"],
+        "vio_pin": config["vio_pin"],
+        "ma_period": config["ma_period"],
+        "ma_mode": config["ma_mode"],
+        "ma_seconds": config["ma_seconds"],
+        "instrumentation": config["instrumentation"],
+        "stats_interval": config["stats_interval"],
+        "rotate_size": config["rotate_size"],
+        "rotate_interval": config["rotate_interval"],
+        "compress": config["compress"],
+        "daemon": daemon,
+        "shm_feed": config["shm_feed"],
+        "std_window": config["std_window"],
+        "max_ticks": config["max_ticks"],
+        "spill_ticks": config["spill_ticks"],
+        "csv_flush_rows": config["csv_flush_rows"],
+        "csv_flush_interval": config["csv_flush_interval"],
+        "buffer_size": config["buffer_size"],
+        "ui_fps": config["ui_fps"],
+        "source": source,
+        "telemetry_port": config["telemetry_port"],
+        "telemetry_rate": config["telemetry_rate"],
+        "rollup": config["rollup"],
+    }
+
+    controller = None
     try:
-        controller = Controller(create_csv=config["enable_csv"], resistor_value=config["resistor_value"], ui_type=config["ui_type"],
-                                polarity_pin=config["pol_pin"], interrupt_pin=config["int_pin"], vio_pin=config["vio_pin"],
-                                ma_period=config["ma_period"])
+        if config["channels"] is not None:
+            controller = MultiChannelController(config["channels"], calibrations=calibrations, **options)
+        else:
+            controller = Controller(polarity_pin=config["pol_pin"], interrupt_pin=config["int_pin"],
+                                    calibration=calibration, **options)
+        if daemon:
+            # stopped cleanly: the history is flushed and the summary written in close()
+            signal.signal(signal.SIGTERM, lambda *_: controller.stop())
+            signal.signal(signal.SIGINT, lambda *_: controller.stop())
         controller.run()
     except KeyboardInterrupt:
-        GPIO.cleanup()
+        cleanup_gpio()
         print('\n\nScript ended normally!')
     except:
         traceback.print_exc()
-        GPIO.cleanup()
+        cleanup_gpio()
         print('\r\n\nScript ended with an error')
+    finally:
+        if controller is not None:
+            controller.close()
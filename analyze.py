@@ -0,0 +1,459 @@
+import sys
+
+if sys.version_info[0] < 3:
+    print('You need to run this with Python 3')
+    sys.exit(1)
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+
+import numpy as np
+
+from amp_o_meter import Tick
+from history import BinaryHistory
+
+# Offline analysis of history files (csv or bin). The file is read in chunks of
+# `chunk_size` ticks into NumPy arrays and every figure is computed with
+# vectorized operations, carrying only a few values (and the last ma_period
+# ticks for the moving average) from one chunk to the next, so the memory used
+# doesn't depend on the size of the file.
+
+CHUNK_SIZE = 1 << 18
+
+
+def iter_history_chunks(file_name, chunk_size=CHUNK_SIZE):
+    # Yields the header values (resistor_value, charge_mC, start, ma_period)
+    # once, then (instants, directions) arrays of up to chunk_size ticks. csv
+    # files don't store the resistor, charge or period, so those are None.
+    if file_name.endswith(".bin"):
+        with BinaryHistory(file_name) as history:
+            yield history.resistor_value, history.charge_mC, history.start, history.ma_period
+            for index in range(0, len(history), chunk_size):
+                # copies, so that no view of the mapping outlives the file
+                yield (history.instants[index:index + chunk_size].copy(),
+                       history.directions[index:index + chunk_size].astype(np.int64))
+        return
+
+    with open(file_name, 'r') as file:
+        file.readline()
+        first_chunk = True
+        while True:
+            lines = list(islice(file, chunk_size))
+            if first_chunk:
+                start = None
+                if lines:
+                    fields = lines[0].split(",")
+                    start = float(fields[0]) - float(fields[1])
+                yield None, None, start, None
+                first_chunk = False
+            if not lines:
+                return
+            rows = np.loadtxt(lines, delimiter=',', usecols=(0, 2), ndmin=2)
+            yield rows[:, 0], rows[:, 1].astype(np.int64)
+
+
+class IntervalStats:
+    # Count, mean, sum of squared deviations and extremes of the intervals
+    # between ticks, merged chunk by chunk (Chan et al.)
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def add(self, intervals):
+        if not len(intervals):
+            return
+
+        count = len(intervals)
+        mean = float(intervals.mean())
+        m2 = float(((intervals - mean) ** 2).sum())
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+        self.min = min(self.min, float(intervals.min()))
+        self.max = max(self.max, float(intervals.max()))
+
+    @property
+    def pstdev(self):
+        return (self.m2 / self.count) ** 0.5 if self.count else 0.0
+
+
+class HistoryAnalysis:
+    # Streaming counterpart of Counter: feed it the ticks of a history file
+    # chunk by chunk with add_chunk(), then read result(). The moving average
+    # is computed exactly as Counter.add_tick does, with ma_period=0 meaning
+    # the average since the start of the run.
+    def __init__(self, charge_mC, start, ma_period=0):
+        self.charge_mC = charge_mC
+        self.start = start
+        self.ma_period = ma_period
+
+        self.number_of_ticks = 0
+        self.number_of_positive_ticks = 0
+        self.number_of_negative_ticks = 0
+        self.direction_sum = 0
+        self.first_instant = None
+        self.last_instant = None
+
+        # intervals between ticks; like Counter (with std_window=0), the
+        # standard deviation of the current leaves out the first ma_period
+        self.intervals = IntervalStats()
+        self.current_intervals = IntervalStats()
+
+        # last ma_period - 1 ticks (instant and cumulative direction sum) and
+        # the last current, carried over to the next chunk
+        self.tail_instants = np.empty(0)
+        self.tail_sums = np.empty(0, dtype=np.int64)
+        self.current = 0.0
+        self.current_sum = 0.0
+        self.current_min = float("inf")
+        self.current_max = float("-inf")
+
+    def add_chunk(self, instants, directions):
+        # returns the moving average current after each tick of the chunk
+        if not len(instants):
+            return np.empty(0)
+
+        offset = self.number_of_ticks
+        if self.first_instant is None:
+            self.first_instant = instants[0]
+            if self.start is None:
+                self.start = instants[0]
+
+        self.add_intervals(instants)
+
+        sums = self.direction_sum + np.cumsum(directions)
+        self.number_of_ticks += len(directions)
+        self.number_of_positive_ticks += int(np.count_nonzero(directions > 0))
+        self.number_of_negative_ticks += int(np.count_nonzero(directions < 0))
+        self.direction_sum = int(sums[-1])
+        self.last_instant = instants[-1]
+
+        if self.ma_period:
+            # the window of tick i starts at tick max(i - ma_period + 1, 0),
+            # whose charge is not counted (see MovingWindow)
+            all_instants = np.concatenate((self.tail_instants, instants))
+            all_sums = np.concatenate((self.tail_sums, sums))
+            tail_offset = offset - len(self.tail_instants)
+
+            ticks = np.arange(offset, offset + len(instants))
+            references = np.maximum(ticks - self.ma_period + 1, 0) - tail_offset
+            charged_ticks = sums - all_sums[references]
+            elapsed = instants - all_instants[references]
+
+            keep = max(self.ma_period - 1, 0)
+            # chunks can be shorter than the tail
+            self.tail_instants = all_instants[max(len(all_instants) - keep, 0):] if keep else np.empty(0)
+            self.tail_sums = all_sums[max(len(all_sums) - keep, 0):] if keep else np.empty(0, dtype=np.int64)
+        else:
+            charged_ticks = sums
+            elapsed = instants - self.start
+
+        # like Counter, the current is only updated when time has passed
+        valid = elapsed > 0
+        currents = np.full(len(instants), np.nan)
+        np.divide(self.charge_mC * charged_ticks, elapsed, out=currents, where=valid)
+        last_valid = np.maximum.accumulate(np.where(valid, np.arange(len(currents)), -1))
+        currents = np.where(last_valid >= 0, currents[np.maximum(last_valid, 0)], self.current)
+        self.current = currents[-1]
+
+        self.current_sum += float(currents.sum())
+        self.current_min = min(self.current_min, float(currents.min()))
+        self.current_max = max(self.current_max, float(currents.max()))
+        return currents
+
+    def add_intervals(self, instants):
+        if self.last_instant is not None:
+            intervals = np.diff(instants, prepend=self.last_instant)
+        else:
+            intervals = np.diff(instants)
+
+        seen = self.intervals.count
+        self.intervals.add(intervals)
+        self.current_intervals.add(intervals[max(self.ma_period - seen, 0):])
+
+    def result(self, voltage=None):
+        duration = self.last_instant - self.start if self.number_of_ticks else 0.0
+        charge = self.charge_mC * self.direction_sum
+        intervals = self.intervals
+
+        result = {
+            "charge_mC_per_tick": self.charge_mC,
+            "ma_period": self.ma_period,
+            "start": self.start,
+            "duration": duration,
+            "number_of_ticks": self.number_of_ticks,
+            "number_of_positive_ticks": self.number_of_positive_ticks,
+            "number_of_negative_ticks": self.number_of_negative_ticks,
+            "charge": charge,
+            "discharged": self.charge_mC * self.number_of_negative_ticks,
+            "recharged": self.charge_mC * self.number_of_positive_ticks,
+            "avg_current": charge / duration if duration > 0 else 0.0,
+            "ma_current_mean": self.current_sum / self.number_of_ticks if self.number_of_ticks else 0.0,
+            "ma_current_min": self.current_min if self.number_of_ticks else 0.0,
+            "ma_current_max": self.current_max if self.number_of_ticks else 0.0,
+            "peak_current": 0.0,
+            "interval_mean": intervals.mean,
+            "interval_std": intervals.pstdev,
+            "interval_min": intervals.min if intervals.count else 0.0,
+            "interval_max": intervals.max,
+            "std_deviation_current": 0.0,
+        }
+
+        if self.number_of_ticks:
+            # the moving average furthest from zero, whichever its direction
+            result["peak_current"] = max(self.current_min, self.current_max, key=abs)
+
+        # same definition as Counter.std_deviation_current
+        current_intervals = self.current_intervals
+        if current_intervals.count > 1 and current_intervals.pstdev != 0:
+            result["std_deviation_current"] = (self.charge_mC / current_intervals.mean -
+                                               self.charge_mC / (current_intervals.mean + current_intervals.pstdev))
+
+        if voltage is not None:
+            result["voltage"] = voltage
+            result["energy"] = charge * voltage / 1000
+            result["energy_discharged"] = result["discharged"] * voltage / 1000
+        return result
+
+
+def analyze(file_name, resistor_value=None, ma_period=None, voltage=None, chunk_size=CHUNK_SIZE,
+            series_file_name=None):
+    # resistor_value and ma_period override the values the file was recorded
+    # with (csv files don't store them: 4.7 ohms and 0 are assumed)
+    chunks = iter_history_chunks(file_name, chunk_size)
+    file_resistor_value, charge_mC, start, file_ma_period = next(chunks)
+
+    if resistor_value is not None or charge_mC is None:
+        if resistor_value is None:
+            resistor_value = file_resistor_value or 4.7
+        charge_mC = 1/(Tick.GVF * resistor_value) * 1000
+    else:
+        resistor_value = file_resistor_value
+    if ma_period is None:
+        ma_period = file_ma_period or 0
+
+    analysis = HistoryAnalysis(charge_mC, start, ma_period)
+    series_file = open(series_file_name, 'w') if series_file_name is not None else None
+    try:
+        if series_file is not None:
+            series_file.write('time_absolute,time_relative,direction,avg_current\n')
+
+        for instants, directions in chunks:
+            currents = analysis.add_chunk(instants, directions)
+            if series_file is not None:
+                np.savetxt(series_file, np.column_stack((instants, instants - analysis.start, directions, currents)),
+                           fmt=['%.6f', '%.6f', '%d', '%.6f'], delimiter=',')
+    finally:
+        if series_file is not None:
+            series_file.close()
+
+    result = analysis.result(voltage)
+    result["file_name"] = file_name
+    result["resistor_value"] = resistor_value
+    return result
+
+
+def find_history_files(paths):
+    # directories are expanded to the history files they contain
+    file_names = []
+    for path in paths:
+        if not os.path.isdir(path):
+            file_names.append(path)
+            continue
+        for name in sorted(os.listdir(path)):
+            if name.endswith((".csv", ".bin")) and name.startswith("history_") and not name.endswith("_analysis.csv"):
+                file_names.append(os.path.join(path, name))
+    return file_names
+
+
+class AnalysisCache:
+    # Results of previous runs, stored as JSON. An entry is only reused if the
+    # file still has the same modification time and size and was analyzed
+    # with the same options, so new and growing files are always recomputed.
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.entries = {}
+        self.changed = False
+
+        if file_name is not None and os.path.exists(file_name):
+            try:
+                with open(file_name, 'r') as cache_file:
+                    self.entries = json.load(cache_file)
+            except ValueError:
+                print("Ignoring invalid cache file {}".format(file_name))
+
+    @staticmethod
+    def key(file_name, options):
+        stat = os.stat(file_name)
+        return os.path.abspath(file_name), [stat.st_mtime_ns, stat.st_size, options]
+
+    def get(self, file_name, options):
+        path, key = self.key(file_name, options)
+        entry = self.entries.get(path)
+        if entry is not None and entry["key"] == key:
+            return dict(entry["result"], file_name=file_name)
+        return None
+
+    def put(self, file_name, options, result):
+        path, key = self.key(file_name, options)
+        self.entries[path] = {"key": key, "result": result}
+        self.changed = True
+
+    def save(self):
+        if self.file_name is None or not self.changed:
+            return
+        temporary_file_name = self.file_name + ".tmp"
+        with open(temporary_file_name, 'w') as cache_file:
+            json.dump(self.entries, cache_file)
+        os.replace(temporary_file_name, self.file_name)
+        self.changed = False
+
+
+def analyze_batch(file_names, resistor_value=None, ma_period=None, voltage=None, chunk_size=CHUNK_SIZE,
+                  workers=None, cache_file_name=None):
+    # Analyzes the files on a pool of `workers` processes (one per core by
+    # default), skipping those already in the cache. Returns the results in
+    # the order of file_names; files that couldn't be read are left out.
+    options = [resistor_value, ma_period, voltage]
+    cache = AnalysisCache(cache_file_name)
+    results = {}
+    pending = []
+
+    for file_name in file_names:
+        result = cache.get(file_name, options)
+        if result is None:
+            pending.append(file_name)
+        else:
+            results[file_name] = result
+
+    print("--- {} files, {} cached, {} to analyze".format(len(file_names), len(results), len(pending)))
+    if pending:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(analyze, file_name, resistor_value, ma_period, voltage, chunk_size): file_name
+                       for file_name in pending}
+            for future in as_completed(futures):
+                file_name = futures[future]
+                try:
+                    results[file_name] = future.result()
+                except Exception as error:
+                    print(" --- ERROR: could not analyze {}: {}".format(file_name, error))
+                    continue
+                cache.put(file_name, options, results[file_name])
+        cache.save()
+
+    return [results[file_name] for file_name in file_names if file_name in results]
+
+
+SUMMARY_COLUMNS = [
+    # (title, result key, format)
+    ("file", "file_name", "{}"),
+    ("duration [s]", "duration", "{:.1f}"),
+    ("ticks +", "number_of_positive_ticks", "{}"),
+    ("ticks -", "number_of_negative_ticks", "{}"),
+    ("avg current [mA]", "avg_current", "{:.4f}"),
+    ("peak current [mA]", "peak_current", "{:.4f}"),
+    ("charge [mC]", "charge", "{:.2f}"),
+]
+
+
+def print_summary(results):
+    rows = [[title for title, _, _ in SUMMARY_COLUMNS]]
+    for result in results:
+        rows.append([form.format(result[key]) for _, key, form in SUMMARY_COLUMNS])
+    rows[1:] = [[os.path.basename(row[0])] + row[1:] for row in rows[1:]]
+
+    widths = [max(len(row[column]) for row in rows) for column in range(len(SUMMARY_COLUMNS))]
+    for row in rows:
+        print("  ".join([row[0].ljust(widths[0])] + [value.rjust(width) for value, width in zip(row[1:], widths[1:])]))
+
+    print("Total: {:.1f} s, {} ticks, {:.2f} mC".format(sum(result["duration"] for result in results),
+                                                       sum(result["number_of_ticks"] for result in results),
+                                                       sum(result["charge"] for result in results)))
+
+
+def write_summary(results, file_name):
+    with open(file_name, 'w') as summary_file:
+        summary_file.write(','.join(key for _, key, _ in SUMMARY_COLUMNS) + '\n')
+        for result in results:
+            summary_file.write(','.join(str(result[key]) for _, key, _ in SUMMARY_COLUMNS) + '\n')
+
+
+def print_result(result):
+    print("--- {}".format(result["file_name"]))
+    print("       Resistor value: {} ohms ({:.4f} mC per tick), ma_period: {}".format(
+        result["resistor_value"], result["charge_mC_per_tick"], result["ma_period"]))
+    print("       Duration: {:.1f} s".format(result["duration"]))
+    print("       Ticks: {} (+{} / -{})".format(result["number_of_ticks"], result["number_of_positive_ticks"],
+                                               result["number_of_negative_ticks"]))
+    print("       Charge: {:.2f} mC (discharged {:.2f} mC, recharged {:.2f} mC)".format(
+        result["charge"], result["discharged"], result["recharged"]))
+    print("       Average current: {:.4f} mA".format(result["avg_current"]))
+    print("       Moving average current: mean {:.4f} mA, min {:.4f} mA, max {:.4f} mA".format(
+        result["ma_current_mean"], result["ma_current_min"], result["ma_current_max"]))
+    print("       Interval between ticks: mean {:.4f} s, std {:.4f} s, min {:.4f} s, max {:.4f} s".format(
+        result["interval_mean"], result["interval_std"], result["interval_min"], result["interval_max"]))
+    print("       Standard deviation: {:.4f} mA".format(result["std_deviation_current"]))
+    if "energy" in result:
+        print("       Energy at {} V: {:.4f} J (discharged {:.4f} J)".format(
+            result["voltage"], result["energy"], result["energy_discharged"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute the figures of amp-o-meter history files")
+    parser.add_argument("files", nargs="+", help="history files (csv or bin) or directories containing them")
+    parser.add_argument("--resistor", type=float, help="resistor value in ohms (default: the file's or 4.7)")
+    parser.add_argument("--ma_period", type=int, help="moving average period in ticks (default: the file's or 0)")
+    parser.add_argument("--voltage", type=float, help="supply voltage, to compute the energy")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE, help="ticks read at a time")
+    parser.add_argument("--series", action="store_true",
+                        help="also write the recomputed moving average to <file>_analysis.csv")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--batch", action="store_true",
+                        help="analyze the files in parallel and print a summary table")
+    parser.add_argument("--workers", type=int, help="processes used by --batch (default: one per core)")
+    parser.add_argument("--cache", help="cache file used by --batch (default: analysis_cache.json next to the files, "
+                                        "'off' to disable)")
+    parser.add_argument("--summary", help="also write the --batch summary table to this csv file")
+    args = parser.parse_args()
+
+    file_names = find_history_files(args.files)
+
+    if args.batch:
+        if args.cache == "off":
+            cache_file_name = None
+        elif args.cache is not None:
+            cache_file_name = args.cache
+        else:
+            cache_directory = os.path.commonpath([os.path.dirname(os.path.abspath(file_name))
+                                                  for file_name in file_names]) if file_names else "."
+            cache_file_name = os.path.join(cache_directory, "analysis_cache.json")
+
+        results = analyze_batch(file_names, args.resistor, args.ma_period, args.voltage, args.chunk_size,
+                                args.workers, cache_file_name)
+        if args.json:
+            print(json.dumps(results, indent=4))
+        else:
+            print_summary(results)
+        if args.summary is not None:
+            write_summary(results, args.summary)
+        sys.exit(0)
+
+    results = []
+    for file_name in file_names:
+        series_file_name = file_name.rsplit('.', 1)[0] + '_analysis.csv' if args.series else None
+        results.append(analyze(file_name, args.resistor, args.ma_period, args.voltage, args.chunk_size,
+                               series_file_name))
+        if not args.json:
+            print_result(results[-1])
+
+    if args.json:
+        print(json.dumps(results, indent=4))
@@ -0,0 +1,341 @@
+import sys
+
+if sys.version_info[0] < 3:
+    print('You need to run this with Python 3')
+    sys.exit(1)
+
+from time import time, sleep, monotonic, perf_counter, perf_counter_ns, strftime, localtime
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+
+from amp_o_meter import Counter, Controller, Tick
+from tick_sources import sleep_until
+
+
+# Measures how fast the Python side of the meter can go, by driving Counter and
+# Controller with synthetic tick streams instead of an LTC4150:
+#
+#   counter:  Counter.add_tick called in a loop, for several ma_period and csv
+#             settings: throughput, per call latency and memory per tick
+#   pipeline: a full Controller fed at a fixed tick rate through its tick
+#             buffer, for several rates and UI types: ticks actually counted,
+#             overruns and the delay between a tick and the first UI refresh
+#             showing it
+#   startup:  time for a fresh interpreter to import each entry point, and
+#             whether that pulled in tkinter
+#
+# Results are printed and saved as JSON so that runs of different versions can
+# be compared.
+
+
+def percentiles(values, points=(50, 90, 99, 99.9)):
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {}
+    for point in points:
+        index = min(int(round(point / 100 * (len(values) - 1))), len(values) - 1)
+        result["p{}".format(point)] = values[index]
+    result["max"] = values[-1]
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def tick_stream(number_of_ticks, rate, recharge_ratio=0.1, seed=0):
+    generator = random.Random(seed)
+    instant = time()
+    for _ in range(number_of_ticks):
+        instant += generator.expovariate(rate)
+        if generator.random() < recharge_ratio:
+            yield instant, Tick.RECHARGING
+        else:
+            yield instant, Tick.DISCHARGING
+
+
+def bench_counter(number_of_ticks, ma_period, csv):
+    ticks = list(tick_stream(number_of_ticks, rate=1000))
+
+    counter = Counter(csv, 4.7, ma_period)
+    counter.start = ticks[0][0]
+    add_tick = counter.add_tick
+    latencies = []
+    start = perf_counter()
+    for instant, direction in ticks:
+        before = perf_counter_ns()
+        add_tick(instant, direction)
+        latencies.append(perf_counter_ns() - before)
+    duration = perf_counter() - start
+    counter.close()
+
+    # tracemalloc slows every allocation down, so memory is measured on a
+    # second run
+    tracemalloc.start()
+    counter = Counter(csv, 4.7, ma_period)
+    counter.start = ticks[0][0]
+    memory_before = tracemalloc.get_traced_memory()[0]
+    for instant, direction in ticks:
+        counter.add_tick(instant, direction)
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    counter.close()
+
+    return {
+        "benchmark": "counter",
+        "ma_period": ma_period,
+        "csv": csv,
+        "ticks": number_of_ticks,
+        "ticks_per_second": number_of_ticks / duration,
+        "latency_us": {key: value / 1000 for key, value in percentiles(latencies).items()},
+        "memory_bytes_per_tick": (memory_after - memory_before) / number_of_ticks,
+        "memory_peak_bytes": memory_peak,
+    }
+
+
+class BenchmarkTickSource:
+    # Pushes ticks into channel 0 at a fixed rate and remembers when each one
+    # was pushed, so that the UI refreshes can be matched with them.
+    def __init__(self, rate, duration):
+        self.rate = rate
+        self.duration = duration
+        self.push_instants = []
+        self.running = False
+        self.thread = None
+
+    def start(self, controller):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(controller,), daemon=True)
+        self.thread.start()
+
+    def run(self, controller):
+        push = controller.tick_buffer.push
+        interval = 1 / self.rate
+        start = monotonic()
+        due = start
+        end = start + self.duration
+
+        while self.running and due < end:
+            if not sleep_until(due, self):
+                return
+
+            # push every tick that is due, the sleep granularity is much
+            # coarser than the interval at high rates
+            now = monotonic()
+            while due <= now and due < end:
+                instant = monotonic()
+                push(instant, 0)
+                self.push_instants.append(instant)
+                due += interval
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def bench_pipeline(rate, duration, ma_period, csv, ui_type, ui_fps):
+    source = BenchmarkTickSource(rate, duration)
+    controller = Controller(16, 20, 21, create_csv="on" if csv else "off", ui_type=ui_type, ma_period=ma_period,
+                            ui_fps=ui_fps, source=source)
+
+    # (refresh instant, ticks shown), recorded every time the UI is refreshed
+    refreshes = []
+    if controller.ui_type is not None:
+        if ui_type == "terminal":
+            controller.gui.headless = True
+        update_gui = controller.update_gui
+
+        def recording_update_gui():
+            update_gui()
+            if controller.last_snapshot is not None:
+                refreshes.append((monotonic(), controller.last_snapshot.number_of_ticks))
+
+        controller.update_gui = recording_update_gui
+
+    cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+    controller.setup_probe()
+    controller.start_ingestion()
+    if ui_type == "gui":
+        controller.start_refresh()
+        controller.gui.root.after(int((duration + 0.5) * 1000), controller.gui.root.quit)
+        controller.gui.root.mainloop()
+    else:
+        if controller.ui_type is not None:
+            controller.start_refresh()
+        sleep(duration + 0.5)
+    controller.close()
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    # the first tick only starts the counter, so tick k is shown once the UI
+    # displays k - 1 ticks
+    latencies = []
+    refresh_index = 0
+    for number, push_instant in enumerate(source.push_instants[1:], 1):
+        while refresh_index < len(refreshes) and refreshes[refresh_index][1] < number:
+            refresh_index += 1
+        if refresh_index == len(refreshes):
+            break
+        latencies.append(refreshes[refresh_index][0] - push_instant)
+
+    pushed = len(source.push_instants)
+    result = {
+        "benchmark": "pipeline",
+        "rate": rate,
+        "duration": duration,
+        "ma_period": ma_period,
+        "csv": csv,
+        "ui_type": ui_type,
+        "ui_fps": ui_fps,
+        "ticks_pushed": pushed,
+        "ticks_counted": controller.counter.number_of_ticks + 1 if controller.did_tick else 0,
+        "overruns": controller.tick_buffer.overruns,
+        "cpu_seconds": (cpu_after.ru_utime + cpu_after.ru_stime) - (cpu_before.ru_utime + cpu_before.ru_stime),
+    }
+    if latencies:
+        result["display_latency_ms"] = {key: value * 1000 for key, value in percentiles(latencies).items()}
+    return result
+
+
+def bench_long_run(number_of_ticks, ma_period, max_ticks):
+    # memory growth of a long capture, sampled every tenth of the run
+    tracemalloc.start()
+    counter = Counter(False, 4.7, ma_period, max_ticks=max_ticks)
+    base = tracemalloc.get_traced_memory()[0]
+    samples = []
+    step = max(number_of_ticks // 10, 1)
+    for index, (instant, direction) in enumerate(tick_stream(number_of_ticks, rate=1000), 1):
+        counter.add_tick(instant, direction)
+        if index % step == 0:
+            samples.append({"ticks": index, "bytes": tracemalloc.get_traced_memory()[0] - base})
+    tracemalloc.stop()
+    counter.close()
+
+    return {
+        "benchmark": "long_run",
+        "ma_period": ma_period,
+        "max_ticks": max_ticks,
+        "ticks": number_of_ticks,
+        "memory": samples,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def bench_startup(module, runs=5):
+    command = [sys.executable, "-c", "import sys, {}; print('tkinter' in sys.modules)".format(module)]
+    directory = os.path.dirname(os.path.abspath(__file__))
+    durations = []
+    for _ in range(runs):
+        start = perf_counter()
+        output = subprocess.check_output(command, cwd=directory)
+        durations.append(perf_counter() - start)
+
+    return {
+        "benchmark": "startup",
+        "module": module,
+        "startup_ms": {key: value * 1000 for key, value in percentiles(durations, (50,)).items()},
+        "imports_tkinter": output.decode().strip() == "True",
+    }
+
+
+def print_result(result):
+    if result["benchmark"] == "counter":
+        print("counter   ma_period={:<5} csv={:<5} {:>10.0f} ticks/s  p50={:.1f}us p99={:.1f}us  {:.1f} B/tick".format(
+            result["ma_period"], str(result["csv"]), result["ticks_per_second"], result["latency_us"]["p50"],
+            result["latency_us"]["p99"], result["memory_bytes_per_tick"]))
+    elif result["benchmark"] == "pipeline":
+        latency = result.get("display_latency_ms", {})
+        print("pipeline  rate={:<6} ui={:<8} csv={:<5} counted {}/{} overruns={} cpu={:.2f}s  "
+              "display p50={}ms p99={}ms".format(
+                  result["rate"], str(result["ui_type"]), str(result["csv"]), result["ticks_counted"],
+                  result["ticks_pushed"], result["overruns"], result["cpu_seconds"],
+                  "{:.1f}".format(latency["p50"]) if latency else "-",
+                  "{:.1f}".format(latency["p99"]) if latency else "-"))
+    elif result["benchmark"] == "startup":
+        print("startup   {:<12} {:.0f} ms (max {:.0f} ms){}".format(
+            result["module"], result["startup_ms"]["p50"], result["startup_ms"]["max"],
+            ", imports tkinter" if result["imports_tkinter"] else ""))
+    else:
+        print("long_run  ma_period={:<5} max_ticks={:<8} {} ticks: {:.1f} MB traced, max rss {} kB".format(
+            result["ma_period"], result["max_ticks"], result["ticks"], result["memory"][-1]["bytes"] / 1e6,
+            result["max_rss_kb"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the tick processing pipeline")
+    parser.add_argument("--quick", action="store_true", help="fewer and shorter runs")
+    parser.add_argument("--ticks", type=int, help="ticks per counter benchmark")
+    parser.add_argument("--duration", type=float, help="seconds per pipeline benchmark")
+    parser.add_argument("--rates", help="comma separated tick rates for the pipeline benchmark")
+    parser.add_argument("--ui_types", help="comma separated UI types for the pipeline benchmark")
+    parser.add_argument("--output", help="JSON file for the results")
+    args = parser.parse_args()
+
+    number_of_ticks = args.ticks or (20000 if args.quick else 200000)
+    duration = args.duration or (1.0 if args.quick else 5.0)
+    if args.rates:
+        rates = [float(rate) for rate in args.rates.split(",")]
+    else:
+        rates = [100, 1000] if args.quick else [100, 1000, 5000, 20000]
+    if args.ui_types:
+        ui_types = args.ui_types.split(",")
+    else:
+        ui_types = ["off", "terminal"]
+        if os.environ.get("DISPLAY"):
+            ui_types.append("gui")
+
+    output = args.output
+    if output is None:
+        output = "bench_results/bench_{}.json".format(strftime('%Y-%m-%d_%H:%M:%S', localtime(time())))
+    output = os.path.abspath(output)
+
+    # history files written during the benchmark go to a scratch directory
+    os.chdir(tempfile.mkdtemp(prefix="amp_o_meter_bench_"))
+
+    results = []
+    for module in ("amp_o_meter", "calibrator", "analyze"):
+        results.append(bench_startup(module))
+        print_result(results[-1])
+
+    for ma_period in (0, 10, 1000):
+        for csv in (False, True):
+            results.append(bench_counter(number_of_ticks, ma_period, csv))
+            print_result(results[-1])
+
+    for rate in rates:
+        for ui_type in ui_types:
+            results.append(bench_pipeline(rate, duration, 10, False, ui_type, 10))
+            print_result(results[-1])
+        results.append(bench_pipeline(rate, duration, 10, True, "off", 10))
+        print_result(results[-1])
+
+    for max_ticks in (0, 100000):
+        results.append(bench_long_run(number_of_ticks * 5, 10, max_ticks))
+        print_result(results[-1])
+
+    if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as results_file:
+        json.dump({
+            "date": strftime('%Y-%m-%d %H:%M:%S', localtime(time())),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "machine": platform.platform(),
+            "results": results,
+        }, results_file, indent=4)
+    print("\nResults saved to {}".format(output))
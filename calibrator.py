@@ -8,47 +8,80 @@ if sys.version_info[0] < 3:
     print('You need to run this with Python 3')
     sys.exit(1)
 
-import numpy as np
 from amp_o_meter import *
 from time import time
 import json
-from sklearn import datasets, linear_model
-from sklearn.metrics import mean_squared_error, r2_score
+import math
 
 
-def create_controller(sensor):
-    controller = Controller(
-        create_csv=sensor["create_csv"],
-        resistor_value=sensor["resistor_value"],
+def create_controller(sensor_list):
+    # all sensors share one controller, one ingestion thread and one clock
+    channels = []
+    for sensor in sensor_list:
+        channels.append({
+            "name": sensor["id"],
+            "int_pin": sensor["interrupt_pin"],
+            "pol_pin": sensor["polarity_pin"],
+            "resistor_value": sensor["resistor_value"]
+        })
+
+    controller = MultiChannelController(
+        channels=channels,
+        create_csv=sensor_list[0]["create_csv"],
         ui_type="off",
-        polarity_pin=sensor["polarity_pin"],
-        interrupt_pin=sensor["interrupt_pin"],
-        vio_pin=sensor["vio_pin"],
-        ma_period=sensor["ma_period"]
+        vio_pin=sensor_list[0]["vio_pin"],
+        ma_period=sensor_list[0]["ma_period"]
     )
     controller.run()
+
+    for sensor, channel in zip(sensor_list, controller.channels):
+        sensor["counter"] = channel.counter
+
     return controller
 
 
+def relative_standard_error(snapshot):
+    # standard error of the mean interval between ticks relative to that mean,
+    # which is also the relative standard error of the measured tick rate
+    if snapshot.interval_count < 2 or snapshot.interval_mean == 0:
+        return float("inf")
+    return snapshot.interval_pstdev / math.sqrt(snapshot.interval_count) / snapshot.interval_mean
+
+
 def calculate_lin_reg_coeffs(x, y):
-    # x = [[1, 1], [1, 2], [1, 3], [1, 4]]
+    # x = [1, 2, 3, 4]
     # y = [10, 8, 6, 4]
-
-    x = np.array(x)[np.newaxis].T
-    y = np.array(y)
-    regr = linear_model.LinearRegression()
-    regr.fit(x, y)
-    y_pred = regr.predict(x)
-    print('Coefficients: y = {:.3g} * x + {:.3g}'.format(regr.coef_[0], regr.intercept_))
-    print("Mean squared error: %.2f" % mean_squared_error(y, y_pred))
-    print('Variance score: %.2f' % r2_score(y, y_pred))
+    # Ordinary least squares in closed form, same results as scikit-learn's
+    # LinearRegression, mean_squared_error and r2_score without loading them
+
+    n = len(x)
+    mean_x = sum(x) / n
+    mean_y = sum(y) / n
+    s_xx = sum((xi - mean_x) ** 2 for xi in x)
+    s_xy = sum((xi - mean_x) * (yi - mean_y) for xi, yi in zip(x, y))
+
+    a = s_xy / s_xx if s_xx else 0.0
+    b = mean_y - a * mean_x
+
+    y_pred = [a * xi + b for xi in x]
+    ss_res = sum((yi - pi) ** 2 for yi, pi in zip(y, y_pred))
+    ss_tot = sum((yi - mean_y) ** 2 for yi in y)
+    mean_squared_error = ss_res / n
+    if ss_tot:
+        r_squared = 1 - ss_res / ss_tot
+    else:
+        r_squared = 1.0 if ss_res == 0 else 0.0
+
+    print('Coefficients: y = {:.3g} * x + {:.3g}'.format(a, b))
+    print("Mean squared error: %.2f" % mean_squared_error)
+    print('Variance score: %.2f' % r_squared)
     print()
 
     return {
-        "a": regr.coef_[0],
-        "b": regr.intercept_,
-        "mean_squared_error": mean_squared_error(y, y_pred),
-        "r_squared": r2_score(y, y_pred)
+        "a": a,
+        "b": b,
+        "mean_squared_error": mean_squared_error,
+        "r_squared": r_squared
     }
 
 
@@ -73,6 +106,22 @@ if __name__ == "__main__":
         print("Could you please type a valid number the next time?")
         raise
 
+    # adaptive tests end as soon as every sensor's tick rate is known within
+    # target_precision, instead of after a fixed number of ticks
+    target_precision = input("Type the target precision in % to end tests adaptively "
+                             "(leave empty to wait for {} ticks): ".format(ema_period))
+    tick_budget = 0
+    try:
+        if target_precision.strip() == "":
+            target_precision = None
+        else:
+            target_precision = float(target_precision.replace(",", ".")) / 100
+            tick_budget = input("Type the maximum number of ticks per sensor in each test (leave empty for no limit): ")
+            tick_budget = int(tick_budget) if tick_budget.strip() else 0
+    except:
+        print("Could you please type a valid number the next time?")
+        raise
+
     number_of_loops = input("How many loops in the sensor? : ")
     try:
         number_of_loops = float(number_of_loops)
@@ -106,10 +155,11 @@ if __name__ == "__main__":
             "vio_pin": 4,
             "ma_period": ema_period
         }
-        sensor["controller"] = create_controller(sensor)
 
         sensor_list.append(sensor)
 
+    controller = create_controller(sensor_list)
+
 
 
 
@@ -136,8 +186,7 @@ if __name__ == "__main__":
                 print("ERROR! ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^")
                 raise
 
-        for sensor in sensor_list:
-            sensor["controller"].reset()
+        controller.reset()
 
         start = time()
         elapsed = 0
@@ -152,10 +201,23 @@ if __name__ == "__main__":
             sys.stdout.write("\033[F"*(len(sensor_list)+1))
             for sensor in sensor_list:
                 # the exact output you're looking for:
-                elapsed_ticks = len(sensor["controller"].counter.ticks)
-                done = done and (elapsed_ticks >= ema_period)
-
-                sys.stdout.write("Sensor %s: [%-20s] %d%%\033[K\n" % (sensor["id"], '=' * min(int(elapsed_ticks / ema_period * 20), 20), min((elapsed_ticks / ema_period * 100), 100)))
+                snapshot = sensor["counter"].snapshot()
+                elapsed_ticks = snapshot.number_of_ticks
+
+                if target_precision is None:
+                    done = done and (elapsed_ticks >= ema_period)
+                    sys.stdout.write("Sensor %s: [%-20s] %d%%\033[K\n" % (sensor["id"], '=' * min(int(elapsed_ticks / ema_period * 20), 20), min((elapsed_ticks / ema_period * 100), 100)))
+                else:
+                    precision = relative_standard_error(snapshot)
+                    converged = elapsed_ticks >= ema_period and precision <= target_precision
+                    done = done and (converged or (tick_budget and elapsed_ticks >= tick_budget))
+
+                    # the error falls with the square root of the ticks, so
+                    # (target / achieved)^2 estimates the fraction of the way
+                    progress = min((target_precision / precision) ** 2, 1) if precision else 1
+                    sys.stdout.write("Sensor %s: [%-20s] %6d ticks, precision %s (target %.2f%%)\033[K\n" % (
+                        sensor["id"], '=' * int(progress * 20), elapsed_ticks,
+                        "%.2f%%" % (precision * 100) if precision != float("inf") else "  -  ", target_precision * 100))
 
             print("Elapsed: {:5.1f} ({:3.0f}%)".format(time()-start, 100*(time()-start)/test_timeout))
             sys.stdout.flush()
@@ -168,13 +230,21 @@ if __name__ == "__main__":
         print()
 
         # Time for the results!
+        test_data["precision"] = {}
         for sensor in sensor_list:
             sensor_id = sensor["id"]
-            ticks_per_second = sensor["controller"].counter.ticks_per_second
+            snapshot = sensor["counter"].snapshot()
+            ticks_per_second = snapshot.ticks_per_second
+            precision = relative_standard_error(snapshot)
+            if target_precision is not None and snapshot.interval_count:
+                # the precision was reached for the rate over the whole test,
+                # not for the moving average over the last ema_period ticks
+                ticks_per_second = 1 / snapshot.interval_mean
 
             test_data["duration"] = duration
             test_data[sensor_id] = ticks_per_second
-            print("   Sensor {}: {:.3f} ticks/second".format(sensor_id, ticks_per_second))
+            test_data["precision"][sensor_id] = precision if precision != float("inf") else None
+            print("   Sensor {}: {:.3f} ticks/second (+- {:.2f}%)".format(sensor_id, ticks_per_second, precision * 100))
         print("")
 
         print(" -- Type again the real current value to begin a test")
@@ -202,7 +272,7 @@ if __name__ == "__main__":
     # y = f(x) -> y = a*x + b
     number_of_tests = len(saved_tests)
     for sensor in sensor_list:
-        del sensor["controller"]
+        del sensor["counter"]
 
         y = []
         x = []
@@ -225,6 +295,8 @@ if __name__ == "__main__":
             with open(file_name, 'w') as json_file:
                 all_data = {
                     "test_timeout": test_timeout,
+                    "target_precision": target_precision,
+                    "tick_budget": tick_budget,
                     "number_of_loops": number_of_loops,
                     "sensor_list": sensor_list,
                     "saved_tests": saved_tests
@@ -240,4 +312,5 @@ if __name__ == "__main__":
             print("Invalid option, please choose another")
 
     print("\n----- Calibration finished. Bye bye! --------------------------------------\n\n")
-    GPIO.cleanup()
+    controller.close()
+    cleanup_gpio()
@@ -0,0 +1,323 @@
+import atexit
+import gzip
+import mmap
+import os
+import queue
+import shutil
+import struct
+import sys
+import threading
+from collections import deque
+from time import time
+
+# Binary history layout (little endian):
+#   header: magic b'AMPH', format version (u16), header size in bytes (u16),
+#           resistor value in ohms (f64), charge per tick in mC (f64),
+#           counter start time (f64), moving average period in ticks (u32)
+#   records: absolute tick time (f64) and direction (i8), 9 bytes each
+BINARY_MAGIC = b'AMPH'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHHdddI')
+BINARY_RECORD = struct.Struct('<db')
+
+
+class HistoryWriter:
+    # Writes history rows from a dedicated thread so that the GPIO callback only
+    # has to put a tuple in a queue. Rows are written in batches: as soon as
+    # flush_rows rows are waiting or flush_interval seconds after the first
+    # row of the batch arrived, whichever comes first. Rows that don't fit in
+    # the queue are counted in dropped_rows instead of blocking the caller.
+    #
+    # With rotate_bytes or rotate_seconds the history is split in segments:
+    # once the current one is that large or that old, it is closed and the
+    # next rows go to a new file (see segment_file_name), each with its own
+    # header. Closed segments are gzipped by a SegmentCompressor if `compress`.
+    STOP = object()
+
+    def __init__(self, file_name, flush_rows=256, flush_interval=1.0, max_queue=65536,
+                 rotate_bytes=0, rotate_seconds=0, compress=False):
+        self.base_file_name = file_name
+        self.file_name = file_name
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queue)
+        self.written_rows = 0
+        self.dropped_rows = 0
+        self.closed = False
+
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compressor = None
+        if compress and (rotate_bytes or rotate_seconds):
+            self.compressor = SegmentCompressor()
+        # every file written so far, with the name it has once compressed
+        self.segments = [file_name]
+
+        self.file = self.open_file()
+        self.segment_start = time()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def open_file(self):
+        raise NotImplementedError
+
+    def write_rows(self, rows):
+        raise NotImplementedError
+
+    def add(self, row):
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self.dropped_rows += 1
+
+    def run(self):
+        rows = []
+        deadline = None
+
+        while True:
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(deadline - time(), 0)
+
+            try:
+                row = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                row = None
+
+            stop = row is self.STOP
+            if row is not None and not stop:
+                if not rows:
+                    deadline = time() + self.flush_interval
+                rows.append(row)
+
+            if rows and (stop or len(rows) >= self.flush_rows or time() >= deadline):
+                self.flush(rows)
+                rows = []
+                deadline = None
+
+            if stop:
+                self.file.close()
+                return
+
+    def flush(self, rows):
+        self.write_rows(rows)
+        self.file.flush()
+        self.written_rows += len(rows)
+
+        if (self.rotate_bytes and self.file.tell() >= self.rotate_bytes or
+                self.rotate_seconds and time() - self.segment_start >= self.rotate_seconds):
+            self.rotate()
+
+    def rotate(self):
+        # runs in the writer thread, only the compression is left to another one
+        self.file.close()
+        if self.compressor is not None:
+            self.compressor.compress(self.file_name)
+            self.segments[-1] = self.file_name + ".gz"
+
+        self.file_name = segment_file_name(self.base_file_name, len(self.segments))
+        self.segments.append(self.file_name)
+        self.file = self.open_file()
+        self.segment_start = time()
+
+    def close(self):
+        # Blocks until every queued row is on disk. Safe to call more than once.
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+
+        self.queue.put(self.STOP)
+        self.thread.join()
+        if self.compressor is not None:
+            self.compressor.close()
+
+
+def segment_file_name(file_name, number):
+    # history_<date>.csv, then history_<date>.001.csv, history_<date>.002.csv...
+    if number == 0:
+        return file_name
+    root, extension = os.path.splitext(file_name)
+    return "{}.{:03d}{}".format(root, number, extension)
+
+
+class SegmentCompressor:
+    # Gzips closed history segments in its own thread, so that neither the
+    # counter nor the history writer wait for it, and removes the originals.
+    def __init__(self, level=6):
+        self.level = level
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def compress(self, file_name):
+        self.queue.put(file_name)
+
+    def run(self):
+        while True:
+            file_name = self.queue.get()
+            if file_name is None:
+                return
+            with open(file_name, 'rb') as source, gzip.open(file_name + ".gz", 'wb', self.level) as target:
+                shutil.copyfileobj(source, target)
+            os.remove(file_name)
+
+    def close(self):
+        # waits for the segments already handed over
+        self.queue.put(None)
+        self.thread.join()
+
+
+class CsvHistoryWriter(HistoryWriter):
+    HEADER = 'time_absolute,time_relative,direction,avg_current\n'
+
+    def open_file(self):
+        file = open(self.file_name, 'w')
+        file.write(self.HEADER)
+        return file
+
+    def write_rows(self, rows):
+        self.file.write(''.join('{},{},{},{}\n'.format(*row) for row in rows))
+
+
+class BinaryHistoryWriter(HistoryWriter):
+    def __init__(self, file_name, resistor_value, charge_mC, ma_period, start, flush_rows=256, flush_interval=1.0,
+                 max_queue=65536, rotate_bytes=0, rotate_seconds=0, compress=False):
+        self.resistor_value = resistor_value
+        self.charge_mC = charge_mC
+        self.ma_period = ma_period
+        self.start = start
+        super().__init__(file_name, flush_rows, flush_interval, max_queue, rotate_bytes, rotate_seconds, compress)
+
+    def header(self):
+        return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BINARY_HEADER.size, self.resistor_value,
+                                  self.charge_mC, self.start, self.ma_period)
+
+    def open_file(self):
+        file = open(self.file_name, 'wb')
+        file.write(self.header())
+        return file
+
+    def write_rows(self, rows):
+        if self.written_rows == 0:
+            # the controller only fixes the start time when the first tick arrives,
+            # so the header is rewritten with the start the rows were measured from
+            self.start = rows[0][0] - rows[0][1]
+            self.file.seek(0)
+            self.file.write(self.header())
+            self.file.seek(0, 2)
+
+        pack = BINARY_RECORD.pack
+        self.file.write(b''.join(pack(row[0], row[2]) for row in rows))
+
+
+class BinaryHistory:
+    # Memory maps a binary history file. `records` is a NumPy structured array
+    # backed directly by the mapping, `instants` and `directions` are views of
+    # its fields, so nothing is copied until the caller does so.
+    def __init__(self, file_name):
+        import numpy as np
+
+        with open(file_name, 'rb') as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_size, resistor_value, charge_mC, start, ma_period = BINARY_HEADER.unpack_from(self.mmap)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            self.mmap.close()
+            raise ValueError("{} is not a binary history file".format(file_name))
+
+        self.file_name = file_name
+        self.resistor_value = resistor_value
+        self.charge_mC = charge_mC
+        self.start = start
+        self.ma_period = ma_period
+
+        # a partially written record at the end of the file is ignored
+        number_of_records = (len(self.mmap) - header_size) // BINARY_RECORD.size
+        dtype = np.dtype({'names': ['instant', 'direction'], 'formats': ['<f8', 'i1'],
+                          'offsets': [0, 8], 'itemsize': BINARY_RECORD.size})
+        self.records = np.frombuffer(self.mmap, dtype=dtype, count=number_of_records, offset=header_size)
+        self.instants = self.records['instant']
+        self.directions = self.records['direction']
+
+    def __len__(self):
+        return len(self.records)
+
+    def close(self):
+        self.records = self.instants = self.directions = None
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def iter_binary_history(file_name):
+    # Pure Python counterpart of BinaryHistory, for machines without NumPy.
+    # Yields the header values once, then (instant, direction) for every record.
+    with open(file_name, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, header_size, resistor_value, charge_mC, start, ma_period = BINARY_HEADER.unpack_from(data)
+            if magic != BINARY_MAGIC or version != BINARY_VERSION:
+                raise ValueError("{} is not a binary history file".format(file_name))
+
+            yield resistor_value, charge_mC, start, ma_period
+
+            end = header_size + (len(data) - header_size) // BINARY_RECORD.size * BINARY_RECORD.size
+            with memoryview(data)[header_size:end] as records:
+                yield from BINARY_RECORD.iter_unpack(records)
+
+
+def binary_to_csv(binary_file_name, csv_file_name=None):
+    # Writes the same layout CsvHistoryWriter produces. avg_current is not
+    # stored in the binary format, so it is recomputed here the way Counter
+    # computes it from the header's charge per tick and moving average period.
+    if csv_file_name is None:
+        csv_file_name = binary_file_name.rsplit('.', 1)[0] + '.csv'
+
+    records = iter_binary_history(binary_file_name)
+    _, charge_mC, start, ma_period = next(records)
+
+    window = deque(maxlen=ma_period) if ma_period else None
+    direction_sum = 0
+    accumulated_charge = 0
+    avg_current = 0
+
+    with open(csv_file_name, 'w') as file:
+        file.write(CsvHistoryWriter.HEADER)
+        for instant, direction in records:
+            if window is not None:
+                if len(window) == ma_period:
+                    direction_sum -= window[0][1]
+                window.append((instant, direction))
+                direction_sum += direction
+
+                accumulated_charge = charge_mC * (direction_sum - window[0][1])
+                elapsed = instant - window[0][0]
+            else:
+                accumulated_charge += charge_mC * direction
+                elapsed = instant - start
+
+            if elapsed > 0:
+                avg_current = accumulated_charge / elapsed
+
+            file.write('{},{},{},{}\n'.format(instant, instant - start, direction, avg_current))
+
+    return csv_file_name
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 history.py history/history_<date>.bin [...]")
+        sys.exit(1)
+
+    for file_name in sys.argv[1:]:
+        print("{} -> {}".format(file_name, binary_to_csv(file_name)))
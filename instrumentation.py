@@ -0,0 +1,228 @@
+import json
+import math
+import os
+from collections import deque
+from time import time, strftime, localtime
+
+# Measurements of the acquisition pipeline itself, enabled with
+# --instrumentation on. They answer whether the Pi keeps up with the ticks:
+#   - processing time: how long Counter.add_tick (and everything it triggers:
+#     history row, rollups) takes per tick, measured in the ingestion thread
+#   - edge delay: time between the moment a tick was pushed into the tick
+#     buffer (the GPIO callback, or the simulated/replayed edge) and the
+#     moment the ingestion thread picked it up
+#   - suspicious intervals between ticks of a channel: much shorter than the
+#     recent ones (a bounce or a duplicated edge) or about twice as long (a
+#     missed edge)
+# Everything is updated by the ingestion thread only; the UI and the stats
+# file just read the totals.
+
+
+class LatencyHistogram:
+    # Logarithmic histogram of durations, with BUCKETS_PER_OCTAVE buckets per
+    # doubling from 1 us up, so percentiles are known within about 20% and
+    # adding a value is constant time whatever the number of values.
+    BUCKETS_PER_OCTAVE = 4
+    NUMBER_OF_BUCKETS = 32 * BUCKETS_PER_OCTAVE  # up to about an hour
+
+    def __init__(self):
+        self.buckets = [0] * self.NUMBER_OF_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        microseconds = seconds * 1e6
+        if microseconds < 1:
+            bucket = 0
+        else:
+            bucket = min(int(math.log2(microseconds) * self.BUCKETS_PER_OCTAVE) + 1, self.NUMBER_OF_BUCKETS - 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def upper_bound(self, bucket):
+        # in seconds
+        return 2 ** (bucket / self.BUCKETS_PER_OCTAVE) * 1e-6
+
+    def percentile(self, point):
+        # upper bound of the bucket holding the `point` percentile, in seconds
+        if not self.count:
+            return 0.0
+        rank = self.count * point / 100
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def clear(self):
+        self.buckets = [0] * self.NUMBER_OF_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+            # non empty buckets as [upper bound in seconds, count]
+            "buckets": [[self.upper_bound(bucket), count] for bucket, count in enumerate(self.buckets) if count],
+        }
+
+
+class IntervalChecker:
+    # Compares every interval between ticks of one channel with an exponential
+    # average of the previous ones. Shorter than `short_ratio` times the
+    # average points to a bounce or a duplicated edge, between `long_ratio`
+    # and `max_long_ratio` times to a missed edge (one tick missing doubles
+    # the interval; much longer gaps are rather a change of load).
+    def __init__(self, short_ratio=0.25, long_ratio=1.75, max_long_ratio=2.5, smoothing=0.1, warmup=8, keep=20):
+        self.short_ratio = short_ratio
+        self.long_ratio = long_ratio
+        self.max_long_ratio = max_long_ratio
+        self.smoothing = smoothing
+        self.warmup = warmup
+        self.previous_instant = None
+        self.typical = None
+        self.intervals = 0
+        self.short = 0
+        self.long = 0
+        # the last `keep` suspicious intervals as (instant, interval, typical interval, kind)
+        self.events = deque(maxlen=keep)
+
+    def add(self, instant):
+        previous_instant = self.previous_instant
+        self.previous_instant = instant
+        if previous_instant is None:
+            return
+
+        interval = instant - previous_instant
+        self.intervals += 1
+        if self.typical is None:
+            self.typical = interval
+            return
+
+        if self.intervals > self.warmup:
+            if interval < self.short_ratio * self.typical:
+                self.short += 1
+                self.events.append((instant, interval, self.typical, "short"))
+                # a duplicated edge says nothing about the load
+                return
+            if self.long_ratio * self.typical <= interval <= self.max_long_ratio * self.typical:
+                self.long += 1
+                self.events.append((instant, interval, self.typical, "long"))
+
+        self.typical += self.smoothing * (interval - self.typical)
+
+    def restart(self):
+        self.previous_instant = None
+
+
+class Instrumentation:
+    # Collects the measurements of a controller's ingestion thread (see
+    # Controller.ingest_batch) and writes them to `stats_file` as JSON every
+    # `dump_interval` seconds and when the controller is closed.
+    def __init__(self, channel_names, stats_file=None, dump_interval=60.0):
+        if stats_file is None:
+            if not os.path.exists('history'):
+                os.makedirs('history')
+            stats_file = "history/stats_{}.json".format(
+                strftime('%Y-%m-%d %H:%M:%S', localtime(time())).replace(' ', '_'))
+
+        self.channel_names = channel_names
+        self.stats_file = stats_file
+        self.dump_interval = dump_interval
+        self.start = time()
+        self.next_dump = self.start + dump_interval
+
+        self.processing = LatencyHistogram()
+        self.edge_delay = LatencyHistogram()
+        self.batches = 0
+        self.max_batch = 0
+        self.checkers = [IntervalChecker() for _ in channel_names]
+
+    def add_batch(self, size):
+        self.batches += 1
+        if size > self.max_batch:
+            self.max_batch = size
+
+    def add_tick(self, index, instant, edge_delay, processing):
+        self.edge_delay.add(edge_delay)
+        self.processing.add(processing)
+        self.checkers[index].add(instant)
+
+    @property
+    def short_intervals(self):
+        return sum(checker.short for checker in self.checkers)
+
+    @property
+    def long_intervals(self):
+        return sum(checker.long for checker in self.checkers)
+
+    def restart(self):
+        # after a reset the time to the next tick is not an interval
+        for checker in self.checkers:
+            checker.restart()
+
+    def summary(self):
+        return {
+            "start": self.start,
+            "time": time(),
+            "processing": self.processing.summary(),
+            "edge_delay": self.edge_delay.summary(),
+            "batches": self.batches,
+            "max_batch": self.max_batch,
+            "channels": [{
+                "name": name,
+                "intervals": checker.intervals,
+                "typical_interval": checker.typical,
+                "short_intervals": checker.short,
+                "long_intervals": checker.long,
+                "events": [{"time": instant, "interval": interval, "typical_interval": typical, "kind": kind}
+                           for instant, interval, typical, kind in checker.events],
+            } for name, checker in zip(self.channel_names, self.checkers)],
+        }
+
+    def maybe_dump(self, overruns=None):
+        if time() >= self.next_dump:
+            self.dump(overruns)
+
+    def dump(self, overruns=None):
+        summary = self.summary()
+        if overruns is not None:
+            summary["overruns"] = overruns
+        self.next_dump = time() + self.dump_interval
+
+        # written next to it first, so a reader never sees half a file
+        temporary_file = self.stats_file + ".tmp"
+        with open(temporary_file, 'w') as file:
+            json.dump(summary, file, indent=1)
+        os.replace(temporary_file, self.stats_file)
+
+
+def format_latency(histogram):
+    if not histogram.count:
+        return "-"
+    return "p50 {}, p99 {}, max {}".format(format_duration(histogram.percentile(50)),
+                                           format_duration(histogram.percentile(99)),
+                                           format_duration(histogram.max))
+
+
+def format_duration(seconds):
+    if seconds < 1e-3:
+        return "{:.0f} us".format(seconds * 1e6)
+    if seconds < 1:
+        return "{:.1f} ms".format(seconds * 1e3)
+    return "{:.2f} s".format(seconds)
@@ -0,0 +1,294 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+from collections import namedtuple
+from time import time, strftime, localtime
+
+# Multi-resolution aggregates of a counter, for captures lasting weeks.
+#
+# Every resolution has its own file, a ring of `capacity` fixed-size buckets
+# addressed directly by time: the bucket starting at t is stored in slot
+# (t // resolution) % capacity. Writing a bucket and reading any time range
+# therefore never scans the file, the files never grow, and only the buckets
+# currently being filled are kept in memory. After a restart the series simply
+# continues in the same files.
+#
+# Layout (little endian):
+#   header: magic b'AMPR', format version (u16), header size in bytes (u16),
+#           resolution in seconds (f64), capacity in buckets (u32)
+#   buckets: bucket number, i.e. start // resolution (i64), positive and
+#            negative ticks (u32 each), net charge in mC (f64), minimum and
+#            maximum interval between ticks in seconds (f64 each), 40 bytes
+# A slot whose bucket number doesn't match the time asked for is empty (it
+# was never written or holds an older bucket that has since been overwritten).
+ROLLUP_MAGIC = b'AMPR'
+ROLLUP_VERSION = 1
+ROLLUP_HEADER = struct.Struct('<4sHHdI')
+ROLLUP_BUCKET = struct.Struct('<qIIddd')
+
+# in their own folder, so that they don't mix with the history files
+DEFAULT_DIRECTORY = os.path.join("history", "rollup")
+
+# (resolution in seconds, capacity in buckets): 1 s for a week, 1 min for a
+# year and 1 h for ten years, about 50 MB in total
+RESOLUTIONS = [(1, 7 * 24 * 3600), (60, 365 * 24 * 60), (3600, 10 * 365 * 24)]
+
+Bucket = namedtuple('Bucket', ['start', 'number_of_positive_ticks', 'number_of_negative_ticks', 'charge',
+                               'min_interval', 'max_interval'])
+
+
+class RollupFile:
+    def __init__(self, file_name, resolution, capacity, create=True):
+        self.file_name = file_name
+        self.resolution = resolution
+        self.capacity = capacity
+
+        if not os.path.exists(file_name):
+            if not create:
+                raise FileNotFoundError(file_name)
+            with open(file_name, 'wb') as file:
+                file.write(ROLLUP_HEADER.pack(ROLLUP_MAGIC, ROLLUP_VERSION, ROLLUP_HEADER.size, resolution, capacity))
+                # sparse on most file systems: the blocks are only allocated once written
+                file.truncate(ROLLUP_HEADER.size + capacity * ROLLUP_BUCKET.size)
+
+        with open(file_name, 'r+b' if create else 'rb') as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE if create else mmap.ACCESS_READ)
+
+        magic, version, self.header_size, self.resolution, self.capacity = ROLLUP_HEADER.unpack_from(self.mmap)
+        if magic != ROLLUP_MAGIC or version != ROLLUP_VERSION:
+            self.mmap.close()
+            raise ValueError("{} is not a rollup file".format(file_name))
+
+    def offset(self, number):
+        return self.header_size + (number % self.capacity) * ROLLUP_BUCKET.size
+
+    def read(self, number):
+        # (positive, negative, charge, min interval, max interval) or None
+        values = ROLLUP_BUCKET.unpack_from(self.mmap, self.offset(number))
+        if values[0] != number or values[1] + values[2] == 0:
+            return None
+        return values[1:]
+
+    def write(self, number, positive, negative, charge, min_interval, max_interval):
+        ROLLUP_BUCKET.pack_into(self.mmap, self.offset(number), number, positive, negative, charge,
+                                min_interval, max_interval)
+
+    def query(self, start, end):
+        # non empty buckets overlapping [start, end), oldest first; only the
+        # last `capacity` buckets are still available
+        last = int(-(-end // self.resolution))
+        first = max(int(start // self.resolution), last - self.capacity)
+
+        buckets = []
+        for number in range(first, last):
+            values = self.read(number)
+            if values is not None:
+                buckets.append(Bucket(number * self.resolution, *values))
+        return buckets
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.mmap.close()
+
+
+class RollupLevel:
+    # The bucket being filled at one resolution. Every merge is written to the
+    # file straight away (a few stores in the mapping), so the file is always
+    # up to date; when a bucket that already exists on disk is reopened after
+    # a restart, it is continued instead of overwritten.
+    def __init__(self, file):
+        self.file = file
+        self.resolution = file.resolution
+        self.number = None
+        self.values = None
+
+    def merge(self, number, positive, negative, charge, min_interval, max_interval):
+        if number != self.number:
+            self.number = number
+            self.values = list(self.file.read(number) or (0, 0, 0.0, float("inf"), 0.0))
+
+        values = self.values
+        values[0] += positive
+        values[1] += negative
+        values[2] += charge
+        values[3] = min(values[3], min_interval)
+        values[4] = max(values[4], max_interval)
+        self.file.write(number, *values)
+
+
+class RollupStore:
+    # Keeps the aggregates of one counter at every resolution of `resolutions`
+    # (the first one being the finest, the others multiples of it). add() only
+    # updates the finest bucket in memory; when that bucket ends its totals are
+    # written and merged into the coarser levels, once per `resolution[0]`.
+    def __init__(self, name="", directory=DEFAULT_DIRECTORY, resolutions=RESOLUTIONS):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.files = [RollupFile(rollup_file_name(directory, name, resolution), resolution, capacity)
+                      for resolution, capacity in resolutions]
+        self.coarser_levels = [RollupLevel(file) for file in self.files[1:]]
+        self.fine_file = self.files[0]
+        self.resolution = self.fine_file.resolution
+
+        self.number = None
+        self.previous_instant = None
+        self.clear_bucket()
+
+    def clear_bucket(self):
+        self.positive = 0
+        self.negative = 0
+        self.charge = 0.0
+        self.min_interval = float("inf")
+        self.max_interval = 0.0
+        # what has already been merged into the coarser levels
+        self.merged = (0, 0, 0.0)
+
+    def open_bucket(self, number):
+        self.number = number
+        self.clear_bucket()
+        stored = self.fine_file.read(number)
+        if stored is not None:
+            # restarted within the same bucket: it was merged when it was saved
+            self.positive, self.negative, self.charge, self.min_interval, self.max_interval = stored
+            self.merged = (self.positive, self.negative, self.charge)
+
+    def add(self, instant, direction, charge_mC):
+        number = int(instant // self.resolution)
+        if number != self.number:
+            self.save_bucket()
+            self.open_bucket(number)
+
+        if direction > 0:
+            self.positive += 1
+        else:
+            self.negative += 1
+        self.charge += charge_mC * direction
+
+        if self.previous_instant is not None:
+            interval = instant - self.previous_instant
+            if interval < self.min_interval:
+                self.min_interval = interval
+            if interval > self.max_interval:
+                self.max_interval = interval
+        self.previous_instant = instant
+
+    def save_bucket(self):
+        if self.number is None or self.positive + self.negative == 0:
+            return
+
+        self.fine_file.write(self.number, self.positive, self.negative, self.charge,
+                             self.min_interval, self.max_interval)
+
+        merged_positive, merged_negative, merged_charge = self.merged
+        start = self.number * self.resolution
+        for level in self.coarser_levels:
+            level.merge(int(start // level.resolution), self.positive - merged_positive,
+                        self.negative - merged_negative, self.charge - merged_charge,
+                        self.min_interval, self.max_interval)
+        self.merged = (self.positive, self.negative, self.charge)
+
+    def restart(self):
+        # the next tick follows a reset, the time since the last one is not an interval
+        self.previous_instant = None
+
+    def query(self, start, end, resolution=None, max_buckets=2000):
+        # the bucket being filled is saved first so that it is included, so
+        # this must be called from the thread adding the ticks
+        self.save_bucket()
+        return query(self.files, start, end, resolution, max_buckets)
+
+    def close(self):
+        self.save_bucket()
+        for file in self.files:
+            file.flush()
+            file.close()
+
+
+def rollup_file_name(directory, name, resolution):
+    suffix = "_" + name if name else ""
+    return os.path.join(directory, "rollup{}_{}s.bin".format(suffix, int(resolution)))
+
+
+def query(files, start, end, resolution=None, max_buckets=2000):
+    # Buckets of [start, end) at `resolution` or, by default, at the finest
+    # resolution that still covers `start` in fewer than max_buckets buckets
+    if resolution is None:
+        candidates = [file for file in files
+                      if (end - start) / file.resolution <= max_buckets and
+                      start >= (end // file.resolution - file.capacity) * file.resolution]
+        chosen = min(candidates or files[-1:], key=lambda file: file.resolution)
+    else:
+        chosen = [file for file in files if file.resolution == resolution]
+        if not chosen:
+            raise ValueError("no rollup at a resolution of {} s".format(resolution))
+        chosen = chosen[0]
+    return chosen.resolution, chosen.query(start, end)
+
+
+def summarize(buckets, start, end):
+    positive = sum(bucket.number_of_positive_ticks for bucket in buckets)
+    negative = sum(bucket.number_of_negative_ticks for bucket in buckets)
+    charge = sum(bucket.charge for bucket in buckets)
+    return {
+        "start": start,
+        "end": end,
+        "number_of_positive_ticks": positive,
+        "number_of_negative_ticks": negative,
+        "charge": charge,
+        "avg_current": charge / (end - start) if end > start else 0.0,
+        "min_interval": min((bucket.min_interval for bucket in buckets), default=0.0),
+        "max_interval": max((bucket.max_interval for bucket in buckets), default=0.0),
+    }
+
+
+def parse_duration(text):
+    # "90", "90s", "30m", "24h" or "7d" in seconds
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the rollup files written with --rollup on")
+    parser.add_argument("--name", default="", help="channel name (empty for a single sensor)")
+    parser.add_argument("--directory", default=DEFAULT_DIRECTORY)
+    parser.add_argument("--last", default="1h", help="time range ending now, e.g. 90s, 30m, 24h, 7d")
+    parser.add_argument("--end", type=float, help="end of the range (unix time, default now)")
+    parser.add_argument("--resolution", type=float, help="bucket size in seconds (default: automatic)")
+    args = parser.parse_args()
+
+    files = []
+    for resolution, capacity in RESOLUTIONS:
+        try:
+            files.append(RollupFile(rollup_file_name(args.directory, args.name, resolution), resolution, capacity,
+                                    create=False))
+        except FileNotFoundError:
+            pass
+    if not files:
+        print("No rollup files found in {}".format(args.directory))
+        sys.exit(1)
+
+    end = args.end if args.end is not None else time()
+    start = end - parse_duration(args.last)
+    resolution, buckets = query(files, start, end, args.resolution)
+
+    print("--- {} buckets of {:g} s".format(len(buckets), resolution))
+    for bucket in buckets:
+        print("{}  +{:<6} -{:<6} {:10.2f} mC {:9.4f} mA".format(
+            strftime('%Y-%m-%d %H:%M:%S', localtime(bucket.start)), bucket.number_of_positive_ticks,
+            bucket.number_of_negative_ticks, bucket.charge, bucket.charge / resolution))
+
+    summary = summarize(buckets, start, end)
+    print("--- {} to {}: {:.2f} mC, {:.4f} mA average, ticks +{} -{}, intervals {:.3f} s to {:.3f} s".format(
+        strftime('%Y-%m-%d %H:%M:%S', localtime(start)), strftime('%Y-%m-%d %H:%M:%S', localtime(end)),
+        summary["charge"], summary["avg_current"], summary["number_of_positive_ticks"],
+        summary["number_of_negative_ticks"], summary["min_interval"], summary["max_interval"]))
+
+    for file in files:
+        file.close()
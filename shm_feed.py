@@ -0,0 +1,289 @@
+import argparse
+import math
+import struct
+import sys
+from collections import namedtuple
+from multiprocessing import shared_memory
+from time import time, sleep
+
+# Live readings of a running amp_o_meter.py in shared memory, for other
+# processes on the same machine: they map the segment and read the values
+# where the counter writes them, without any request or copy through a socket.
+#
+# Layout of the segment (little endian, offsets in bytes):
+#   header, HEADER_SIZE bytes:
+#     magic b'AMPF', format version (u16), header size (u16), channel block
+#     size (u16), number of channels (u16), tick ring capacity in ticks (u32),
+#     offset of the tick ring (u32)
+#   one channel block per channel, CHANNEL_BLOCK_SIZE bytes each:
+#     seqlock counter (u64), then CHANNEL_FIELDS: snapshot sequence (u64),
+#     start time (f64), ticks, positive ticks and negative ticks (u64 each),
+#     ticks per second, accumulated charge (mC), average current (mA),
+#     standard deviation (mA), instant current (mA), time of the last tick and
+#     last interval between ticks (f64 each, NaN before there is one),
+#     direction of the last tick (i64), charge per tick (mC), calibration
+#     offset (mA), time of the update (f64 each) and channel name (16 bytes,
+#     utf-8, NUL padded)
+#   tick ring, at its offset:
+#     reserved and written positions (u64 each), padded to RING_HEADER_SIZE,
+#     then `capacity` TICK_RECORDs: absolute time (f64), direction (i8) and
+#     channel index (u8), padded to 16 bytes. Tick number n (counting from 0
+#     since the counter started) is in slot n % capacity. The first tick of a
+#     channel only starts its counter (see Channel.add_tick) and is not in the
+#     ring, so the ring has as many ticks of a channel as its number of ticks,
+#     until a reset: a reset zeroes the channel blocks but not the positions.
+#
+# Channel blocks are protected by a seqlock: the writer makes the counter odd,
+# writes the fields and makes it even again, so a reader that sees the same
+# even value before and after reading the fields has a consistent copy and
+# retries otherwise. The ring is written in batches: the writer advances
+# `reserved` to the end of the batch, writes the records, then advances
+# `written`. Records below `written` are complete; those below
+# `reserved - capacity` may have been overwritten while they were read.
+#
+# Times are seconds since the epoch. Only one process (the counter) writes.
+
+FEED_MAGIC = b'AMPF'
+FEED_VERSION = 1
+DEFAULT_NAME = "amp_o_meter"
+
+HEADER = struct.Struct('<4sHHHHII')
+HEADER_SIZE = 64
+SEQLOCK = struct.Struct('<Q')
+CHANNEL_FIELDS = struct.Struct('<QdQQQdddddddqddd16s')
+CHANNEL_BLOCK_SIZE = 192
+RING_POSITIONS = struct.Struct('<QQ')
+RING_HEADER_SIZE = 64
+TICK_RECORD = struct.Struct('<dbB6x')
+
+ChannelState = namedtuple('ChannelState', ['sequence', 'start', 'number_of_ticks', 'number_of_positive_ticks',
+                                           'number_of_negative_ticks', 'ticks_per_second', 'accumulated_charge',
+                                           'avg_current', 'std_deviation_current', 'instant_current',
+                                           'last_tick_instant', 'last_interval', 'last_direction', 'charge_mC',
+                                           'current_offset', 'updated', 'name'])
+
+
+def segment_size(number_of_channels, capacity):
+    return HEADER_SIZE + number_of_channels * CHANNEL_BLOCK_SIZE + RING_HEADER_SIZE + capacity * TICK_RECORD.size
+
+
+def attach(name):
+    # Opens an existing segment without handing it to the resource tracker,
+    # which would otherwise remove it when the reading process exits
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+
+    segment = shared_memory.SharedMemory(name)
+    from multiprocessing import resource_tracker
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class ShmFeedWriter:
+    # Writes the published snapshots of a controller's counters and its ticks
+    # to the segment `name`. update() is registered as a tick listener, so it
+    # runs in the ingestion thread after every batch (and after a reset).
+    def __init__(self, controller, name=DEFAULT_NAME, capacity=4096):
+        self.controller = controller
+        self.name = name
+        self.capacity = capacity
+        self.number_of_channels = len(controller.channels)
+        size = segment_size(self.number_of_channels, capacity)
+
+        try:
+            self.segment = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a counter that didn't exit cleanly
+            stale = attach(name)
+            stale.close()
+            stale.unlink()
+            self.segment = shared_memory.SharedMemory(name, create=True, size=size)
+
+        self.buffer = self.segment.buf
+        self.ring_offset = HEADER_SIZE + self.number_of_channels * CHANNEL_BLOCK_SIZE
+        self.records_offset = self.ring_offset + RING_HEADER_SIZE
+        self.position = 0
+        # whether the first tick of each channel, which isn't counted, was seen
+        self.started = [channel.did_tick for channel in controller.channels]
+
+        HEADER.pack_into(self.buffer, 0, FEED_MAGIC, FEED_VERSION, HEADER_SIZE, CHANNEL_BLOCK_SIZE,
+                         self.number_of_channels, capacity, self.ring_offset)
+        self.update([])
+
+    def start(self):
+        self.controller.tick_listeners.append(self.update)
+
+    def update(self, batch):
+        if batch:
+            self.write_ticks(batch)
+        for index, channel in enumerate(self.controller.channels):
+            self.write_channel(index, channel)
+
+    def write_ticks(self, batch):
+        started = self.started
+        if not all(started):
+            counted = []
+            for tick in batch:
+                if started[tick[2]]:
+                    counted.append(tick)
+                else:
+                    started[tick[2]] = True
+            batch = counted
+            if not batch:
+                return
+
+        clock_offset = self.controller.clock_offset
+        capacity = self.capacity
+        if len(batch) > capacity:
+            self.position += len(batch) - capacity
+            batch = batch[-capacity:]
+
+        end = self.position + len(batch)
+        RING_POSITIONS.pack_into(self.buffer, self.ring_offset, end, self.position)
+
+        buffer = self.buffer
+        records_offset = self.records_offset
+        pack_into = TICK_RECORD.pack_into
+        position = self.position
+        for instant, polarity, index in batch:
+            pack_into(buffer, records_offset + (position % capacity) * TICK_RECORD.size,
+                      instant + clock_offset, 1 if polarity else -1, index)
+            position += 1
+
+        self.position = end
+        RING_POSITIONS.pack_into(buffer, self.ring_offset, end, end)
+
+    def write_channel(self, index, channel):
+        counter = channel.counter
+        snapshot = counter.published
+        offset = HEADER_SIZE + index * CHANNEL_BLOCK_SIZE
+        lock = SEQLOCK.unpack_from(self.buffer, offset)[0]
+
+        SEQLOCK.pack_into(self.buffer, offset, lock + 1)
+        CHANNEL_FIELDS.pack_into(
+            self.buffer, offset + SEQLOCK.size, snapshot.sequence, snapshot.start, snapshot.number_of_ticks,
+            snapshot.number_of_positive_ticks, snapshot.number_of_negative_ticks, snapshot.ticks_per_second,
+            snapshot.accumulated_charge, snapshot.avg_current, snapshot.std_deviation_current,
+            snapshot.instant_current,
+            math.nan if snapshot.last_tick_instant is None else snapshot.last_tick_instant,
+            math.nan if snapshot.last_interval is None else snapshot.last_interval,
+            snapshot.last_direction, counter.charge_mC, counter.current_offset, time(), channel.name.encode()[:16])
+        SEQLOCK.pack_into(self.buffer, offset, lock + 2)
+
+    def close(self):
+        if self.update in self.controller.tick_listeners:
+            self.controller.tick_listeners.remove(self.update)
+        self.buffer.release()
+        self.segment.close()
+        self.segment.unlink()
+
+
+class ShmFeedReader:
+    # Reads the segment written by ShmFeedWriter, from any process
+    def __init__(self, name=DEFAULT_NAME):
+        self.segment = attach(name)
+        self.buffer = self.segment.buf
+
+        magic, version, self.header_size, self.block_size, self.number_of_channels, self.capacity, \
+            self.ring_offset = HEADER.unpack_from(self.buffer)
+        if magic != FEED_MAGIC or version != FEED_VERSION:
+            self.close()
+            raise ValueError("shared memory segment {} is not an amp_o_meter feed".format(name))
+        self.records_offset = self.ring_offset + RING_HEADER_SIZE
+
+    def channel(self, index):
+        offset = self.header_size + index * self.block_size
+        while True:
+            before = SEQLOCK.unpack_from(self.buffer, offset)[0]
+            if before & 1:
+                # being written, which only takes a few microseconds
+                sleep(0)
+                continue
+            values = CHANNEL_FIELDS.unpack_from(self.buffer, offset + SEQLOCK.size)
+            if SEQLOCK.unpack_from(self.buffer, offset)[0] == before:
+                break
+
+        return ChannelState(*values[:-1], values[-1].rstrip(b'\0').decode(errors='replace'))
+
+    def channels(self):
+        return [self.channel(index) for index in range(self.number_of_channels)]
+
+    def instant_current(self, state, now=None):
+        # the instant current of `state` brought up to `now`, see Counter.instant_current
+        if math.isnan(state.last_interval) or math.isnan(state.last_tick_instant):
+            return 0.0
+        if now is None:
+            now = time()
+
+        interval = max(state.last_interval, now - state.last_tick_instant)
+        if interval <= 0:
+            return 0.0
+        current = state.charge_mC * state.last_direction / interval
+        if state.current_offset:
+            current += math.copysign(1, current) * state.current_offset
+        return current
+
+    @property
+    def position(self):
+        # number of ticks written so far
+        return RING_POSITIONS.unpack_from(self.buffer, self.ring_offset)[1]
+
+    def ticks(self, since=0):
+        # (time, direction, channel index) of the ticks written since position
+        # `since` that are still in the ring, and the position to pass next time
+        end = self.position
+        start = max(since, end - self.capacity)
+        ticks = [TICK_RECORD.unpack_from(self.buffer, self.records_offset + (position % self.capacity) *
+                                         TICK_RECORD.size) for position in range(start, end)]
+
+        # drops the records the writer may have overwritten meanwhile
+        reserved = RING_POSITIONS.unpack_from(self.buffer, self.ring_offset)[0]
+        overwritten = reserved - self.capacity - start
+        if overwritten > 0:
+            ticks = ticks[overwritten:]
+        return ticks, end
+
+    def tick_records(self):
+        # the whole ring as a NumPy structured array backed by the segment (no
+        # copy), in slot order; see ticks() for which records are valid
+        import numpy as np
+
+        dtype = np.dtype({'names': ['instant', 'direction', 'channel'], 'formats': ['<f8', 'i1', 'u1'],
+                          'offsets': [0, 8, 9], 'itemsize': TICK_RECORD.size})
+        return np.frombuffer(self.buffer, dtype=dtype, count=self.capacity, offset=self.records_offset)
+
+    def close(self):
+        self.buffer = None
+        self.segment.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the live readings of amp_o_meter.py --shm_feed")
+    parser.add_argument("--name", default=DEFAULT_NAME)
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--ticks", action="store_true", help="also print every tick")
+    args = parser.parse_args()
+
+    try:
+        with ShmFeedReader(args.name) as reader:
+            position = reader.position
+            while True:
+                if args.ticks:
+                    ticks, position = reader.ticks(position)
+                    for instant, direction, index in ticks:
+                        print("tick {:.6f} {:+d} channel {}".format(instant, direction, index))
+                print(" | ".join("{}: {:.3f} mA ({:.3f} mA now), {:.2f} mC, {} ticks".format(
+                    state.name or "counter", state.avg_current, reader.instant_current(state),
+                    state.accumulated_charge, state.number_of_ticks) for state in reader.channels()))
+                sleep(args.interval)
+    except FileNotFoundError:
+        print("No feed named {}, start amp_o_meter.py with --shm_feed".format(args.name))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
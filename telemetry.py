@@ -0,0 +1,270 @@
+import asyncio
+import argparse
+import json
+import socket
+import threading
+from time import time
+
+# Live readings over TCP, for any number of viewers besides the local UI.
+#
+# The protocol is newline delimited JSON in both directions. On connection
+# the server sends
+#   {"type": "hello", "channels": [...], "rate": ...}
+# and then, `rate` times per second,
+#   {"type": "snapshot", "time": ..., "overruns": ..., "channels": [{...}, ...]}
+# with the fields of CounterSnapshot (plus "name") for every channel. A client
+# may send
+#   {"command": "subscribe", "stream": "ticks"}
+# to also receive every tick as it is ingested, in batches of
+#   {"type": "ticks", "ticks": [[absolute time, direction, channel index], ...]}
+# and {"command": "unsubscribe", "stream": "ticks"} to stop them.
+#
+# Every client has its own bounded queue: when a client doesn't read fast
+# enough its messages are dropped (and it is told how many with a
+# {"type": "dropped", "count": ...} message), so a slow client never delays
+# the other clients or the acquisition.
+
+DEFAULT_PORT = 8765
+
+
+class Subscriber:
+    def __init__(self, writer, max_queue):
+        self.writer = writer
+        self.task = None
+        self.queue = asyncio.Queue(max_queue)
+        self.ticks = False
+        self.dropped = 0
+        self.reported_dropped = 0
+
+    def send(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def write(self):
+        while True:
+            message = await self.queue.get()
+            self.writer.write(message)
+            if self.dropped != self.reported_dropped:
+                self.writer.write(encode({"type": "dropped", "count": self.dropped}))
+                self.reported_dropped = self.dropped
+            await self.writer.drain()
+
+
+def encode(message):
+    return (json.dumps(message) + "\n").encode()
+
+
+class TelemetryServer:
+    # Serves the readings of a controller's channels from an asyncio event loop
+    # running in its own thread. Snapshots are taken `rate` times per second;
+    # ticks come from the controller's ingestion thread through
+    # Controller.tick_listeners and are handed over to the loop once per batch.
+    def __init__(self, controller, port=DEFAULT_PORT, host="127.0.0.1", rate=2.0, max_queue=256):
+        self.controller = controller
+        self.port = port
+        self.host = host
+        self.rate = rate
+        self.max_queue = max_queue
+        self.subscribers = set()
+        self.tick_subscribers = 0
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self.publisher = None
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        # raises here if the port can't be used
+        asyncio.run_coroutine_threadsafe(self.open(), self.loop).result()
+        self.controller.tick_listeners.append(self.on_ticks)
+
+    async def open(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.publisher = asyncio.ensure_future(self.publish_snapshots())
+
+    def stop(self):
+        if self.loop is None:
+            return
+
+        if self.on_ticks in self.controller.tick_listeners:
+            self.controller.tick_listeners.remove(self.on_ticks)
+        asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+    async def close(self):
+        self.server.close()
+        tasks = [self.publisher]
+        for subscriber in list(self.subscribers):
+            tasks.append(subscriber.task)
+            subscriber.writer.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def hello(self):
+        return {
+            "type": "hello",
+            "channels": [channel.name for channel in self.controller.channels],
+            "resistor_value": [channel.counter.resistor_value for channel in self.controller.channels],
+            "charge_mC": [channel.counter.charge_mC for channel in self.controller.channels],
+            "ma_period": self.controller.ma_period,
+            "rate": self.rate,
+        }
+
+    def snapshot(self):
+        channels = []
+        for channel in self.controller.channels:
+            snapshot = channel.counter.snapshot()._asdict()
+            snapshot["name"] = channel.name
+            channels.append(snapshot)
+        return {
+            "type": "snapshot",
+            "time": time(),
+            "overruns": self.controller.tick_buffer.overruns,
+            "channels": channels,
+        }
+
+    async def publish_snapshots(self):
+        while True:
+            if self.subscribers:
+                # encoded once, whatever the number of subscribers
+                message = encode(self.snapshot())
+                for subscriber in self.subscribers:
+                    subscriber.send(message)
+            await asyncio.sleep(1 / self.rate)
+
+    def on_ticks(self, batch):
+        # runs in the ingestion thread, so only the hand over is done here;
+        # an empty batch only means that the counters changed (a reset)
+        if not batch or not self.tick_subscribers:
+            return
+        clock_offset = self.controller.clock_offset
+        ticks = [(instant + clock_offset, 1 if polarity else -1, index) for instant, polarity, index in batch]
+        self.loop.call_soon_threadsafe(self.publish_ticks, ticks)
+
+    def publish_ticks(self, ticks):
+        message = encode({"type": "ticks", "ticks": ticks})
+        for subscriber in self.subscribers:
+            if subscriber.ticks:
+                subscriber.send(message)
+
+    async def handle_client(self, reader, writer):
+        subscriber = Subscriber(writer, self.max_queue)
+        subscriber.send(encode(self.hello()))
+        self.subscribers.add(subscriber)
+        subscriber.task = asyncio.ensure_future(subscriber.write())
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    command = json.loads(line)
+                except ValueError:
+                    subscriber.send(encode({"type": "error", "message": "invalid JSON"}))
+                    continue
+                self.handle_command(subscriber, command)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            if subscriber.ticks:
+                self.tick_subscribers -= 1
+            subscriber.task.cancel()
+            writer.close()
+
+    def handle_command(self, subscriber, command):
+        if command.get("stream") != "ticks" or command.get("command") not in ("subscribe", "unsubscribe"):
+            subscriber.send(encode({"type": "error", "message": "unknown command"}))
+            return
+
+        ticks = command["command"] == "subscribe"
+        if ticks != subscriber.ticks:
+            subscriber.ticks = ticks
+            self.tick_subscribers += 1 if ticks else -1
+
+
+class TelemetryClient:
+    # Blocking client for scripts: iterate over it to get the messages sent by
+    # the server as dicts.
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, timeout=None):
+        self.socket = socket.create_connection((host, port), timeout)
+        self.file = self.socket.makefile('rb')
+        self.hello = self.receive()
+
+    def send(self, command):
+        self.socket.sendall(encode(command))
+
+    def subscribe_ticks(self):
+        self.send({"command": "subscribe", "stream": "ticks"})
+
+    def unsubscribe_ticks(self):
+        self.send({"command": "unsubscribe", "stream": "ticks"})
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("telemetry server closed the connection")
+        return json.loads(line)
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.receive()
+            except ConnectionError:
+                return
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def print_message(message):
+    if message["type"] == "snapshot":
+        print(" | ".join("{}: {:.3f} mA, {:.2f} mC, {} ticks".format(
+            channel["name"] or "counter", channel["avg_current"], channel["accumulated_charge"],
+            channel["number_of_ticks"]) for channel in message["channels"]))
+    elif message["type"] == "ticks":
+        for instant, direction, index in message["ticks"]:
+            print("tick {:.6f} {:+d} channel {}".format(instant, direction, index))
+    else:
+        print(message)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the live readings of a running amp_o_meter.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--ticks", action="store_true", help="also print every tick")
+    parser.add_argument("--json", action="store_true", help="print the raw JSON messages")
+    args = parser.parse_args()
+
+    try:
+        with TelemetryClient(args.host, args.port) as client:
+            print("--- Connected, channels: {}".format(", ".join(client.hello["channels"]) or "counter"))
+            if args.ticks:
+                client.subscribe_ticks()
+            for message in client:
+                if args.json:
+                    print(json.dumps(message))
+                else:
+                    print_message(message)
+    except KeyboardInterrupt:
+        pass
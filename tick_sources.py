@@ -0,0 +1,421 @@
+import heapq
+import os
+import random
+import select
+import struct
+import threading
+from time import monotonic, sleep, time
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # without RPi.GPIO only the simulated and replay sources can be used
+    GPIO = None
+
+from history import iter_binary_history
+
+
+# A tick source feeds a controller's tick buffer. start(controller) is called
+# once the controller's channels exist and must return immediately; every tick
+# is pushed as controller.tick_buffer.push(monotonic(), polarity, channel.index)
+# with polarity 1 when the LTC4150 is being recharged and 0 otherwise.
+
+
+def cleanup_gpio():
+    if GPIO is not None:
+        GPIO.cleanup()
+
+
+def sleep_until(deadline, source):
+    # sleeps in short steps so that stop() doesn't wait for long gaps between
+    # ticks; returns False if the source was stopped meanwhile
+    while source.running:
+        delay = deadline - monotonic()
+        if delay <= 0:
+            return True
+        sleep(min(delay, 0.1))
+    return False
+
+
+class GpioTickSource:
+    def start(self, controller):
+        if GPIO is None:
+            print(" --- ERROR: RPi.GPIO is not installed, use a simulated or replay source instead! ---")
+            raise Exception
+
+        GPIO.setmode(GPIO.BCM)
+
+        for channel in controller.channels:
+            GPIO.setup(channel.interrupt_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            GPIO.setup(channel.polarity_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+
+        GPIO.setup(controller.vio_pin, GPIO.OUT)
+        GPIO.output(controller.vio_pin, GPIO.HIGH)
+
+        for channel in controller.channels:
+            GPIO.add_event_detect(channel.interrupt_pin, GPIO.FALLING,
+                                  callback=self.probe_callback(controller.tick_buffer, channel))
+
+    def probe_callback(self, tick_buffer, channel):
+        push = tick_buffer.push
+        polarity_pin = channel.polarity_pin
+        index = channel.index
+
+        def callback(_):
+            # runs in the RPi.GPIO thread: everything else is left to Controller.ingest()
+            push(monotonic(), GPIO.input(polarity_pin), index)
+
+        return callback
+
+    def stop(self):
+        pass
+
+
+# Linux GPIO character device, version 1 of the userspace ABI (linux/gpio.h)
+def _iowr(number, size):
+    return (3 << 30) | (size << 16) | (0xB4 << 8) | number
+
+
+# struct gpiohandle_request: line offsets (u32 x 64), flags (u32), default
+# values (u8 x 64), consumer label (32 chars), number of lines (u32), fd (int)
+GPIOHANDLE_REQUEST = struct.Struct('<64II64s32sIi')
+# struct gpioevent_request: line offset (u32), handle flags (u32), event
+# flags (u32), consumer label (32 chars), fd (int)
+GPIOEVENT_REQUEST = struct.Struct('<III32si')
+# struct gpioevent_data: timestamp in ns (u64), event id (u32), padded to 16 bytes
+GPIOEVENT_DATA = struct.Struct('<QI4x')
+# struct gpiohandle_data: values (u8 x 64)
+GPIOHANDLE_DATA_SIZE = 64
+
+GPIO_GET_LINEHANDLE_IOCTL = _iowr(0x03, GPIOHANDLE_REQUEST.size)
+GPIO_GET_LINEEVENT_IOCTL = _iowr(0x04, GPIOEVENT_REQUEST.size)
+GPIOHANDLE_GET_LINE_VALUES_IOCTL = _iowr(0x08, GPIOHANDLE_DATA_SIZE)
+
+GPIOHANDLE_REQUEST_INPUT = 1 << 0
+GPIOHANDLE_REQUEST_OUTPUT = 1 << 1
+GPIOHANDLE_REQUEST_BIAS_PULL_UP = 1 << 5
+GPIOHANDLE_REQUEST_BIAS_PULL_DOWN = 1 << 6
+GPIOEVENT_REQUEST_FALLING_EDGE = 1 << 1
+GPIOEVENT_EVENT_FALLING_EDGE = 0x02
+
+CONSUMER_LABEL = b'amp_o_meter'
+
+
+def request_line_handle(chip_fd, line, flags, default_value=0):
+    import fcntl
+
+    request = bytearray(GPIOHANDLE_REQUEST.pack(*([line] + [0] * 63), flags, bytes([default_value]) + bytes(63),
+                                                 CONSUMER_LABEL, 1, 0))
+    fcntl.ioctl(chip_fd, GPIO_GET_LINEHANDLE_IOCTL, request)
+    return GPIOHANDLE_REQUEST.unpack(request)[-1]
+
+
+def parse_current_profile(profile):
+    # "5" is a constant 5 mA, "5:10,0.5:60" is 5 mA for 10 s then 0.5 mA for
+    # 60 s, repeated for as long as the source runs
+    segments = []
+    for segment in str(profile).split(","):
+        if ":" in segment:
+            current, duration = segment.split(":")
+            segments.append((float(current), float(duration)))
+        else:
+            segments.append((float(segment), float("inf")))
+    return segments
+
+
+class SyntheticTickSource:
+    # Generates the ticks an LTC4150 would produce for a given current profile
+    # (in mA, see parse_current_profile) on every channel of the controller.
+    # recharge_ratio is the fraction of ticks flagged as recharging and jitter
+    # the relative standard deviation applied to each interval.
+    def __init__(self, current_profile=5.0, recharge_ratio=0.0, jitter=0.0, seed=None):
+        if isinstance(current_profile, (int, float)):
+            current_profile = [(float(current_profile), float("inf"))]
+        elif isinstance(current_profile, str):
+            current_profile = parse_current_profile(current_profile)
+
+        self.current_profile = current_profile
+        self.profile_duration = sum(duration for _, duration in current_profile)
+        self.recharge_ratio = recharge_ratio
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.running = False
+        self.thread = None
+
+    def current_at(self, elapsed):
+        # returns the current at `elapsed` seconds and when that segment ends
+        if self.profile_duration != float("inf"):
+            cycle_start = elapsed - elapsed % self.profile_duration
+            elapsed -= cycle_start
+        else:
+            cycle_start = 0
+
+        segment_end = 0
+        for current, duration in self.current_profile:
+            segment_end += duration
+            if elapsed < segment_end:
+                return current, cycle_start + segment_end
+        return self.current_profile[-1][0], float("inf")
+
+    def interval(self, charge_mC, elapsed):
+        current, segment_end = self.current_at(elapsed)
+        if current <= 0:
+            return segment_end - elapsed, False
+
+        interval = charge_mC / current
+        if self.jitter:
+            interval *= max(self.random.gauss(1, self.jitter), 0.01)
+        return interval, True
+
+    def start(self, controller):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(controller,), daemon=True)
+        self.thread.start()
+
+    def run(self, controller):
+        push = controller.tick_buffer.push
+        start = monotonic()
+
+        # (time of the next tick, channel index, whether it is a real tick or
+        # only the end of a segment without current)
+        schedule = []
+        for channel in controller.channels:
+            interval, is_tick = self.interval(channel.counter.charge_mC, 0)
+            heapq.heappush(schedule, (start + interval, channel.index, is_tick))
+
+        while self.running:
+            due, index, is_tick = heapq.heappop(schedule)
+            if not sleep_until(due, self):
+                return
+
+            if is_tick:
+                push(monotonic(), self.random.random() < self.recharge_ratio, index)
+
+            interval, is_tick = self.interval(controller.channels[index].counter.charge_mC, due - start)
+            heapq.heappush(schedule, (due + interval, index, is_tick))
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class LineValue:
+    # Reads the current value of a line requested with request_line_handle
+    def __init__(self, fd):
+        self.fd = fd
+        self.data = bytearray(GPIOHANDLE_DATA_SIZE)
+
+    def __call__(self):
+        import fcntl
+
+        fcntl.ioctl(self.fd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, self.data)
+        return self.data[0]
+
+
+class GpioChipTickSource:
+    # Reads the falling edges of the interrupt pins from the GPIO character
+    # device (/dev/gpiochipN) instead of RPi.GPIO callbacks. The kernel
+    # timestamps every edge when it happens, so the time the reading thread
+    # takes to be scheduled doesn't end up in the intervals, and all the
+    # edges waiting on a line are read at once, up to `batch_size` per read.
+    # The polarity pin is read for every event as it is read; it only changes
+    # with the direction of the current, so this is only off for the edges
+    # read in the same batch as a change of direction.
+    #
+    # Timestamps are CLOCK_MONOTONIC, the clock of time.monotonic(), since
+    # Linux 5.7; older kernels use CLOCK_REALTIME, which is detected from the
+    # first event and converted.
+    #
+    # from_fds() builds a source reading event records from any file
+    # descriptors (a pipe, or lines of the kernel's gpio-sim) instead, with
+    # the polarity of each channel given by a callable.
+    def __init__(self, chip="/dev/gpiochip0", batch_size=64):
+        self.chip = chip
+        self.batch_size = batch_size
+        self.lines = []
+        self.fds = []
+        self.clock_correction = None
+        self.running = False
+        self.thread = None
+
+    @classmethod
+    def from_fds(cls, event_fds, polarities=None, batch_size=64):
+        # event_fds[i] and polarities[i] are for the channel of index i
+        source = cls(chip=None, batch_size=batch_size)
+        for index, fd in enumerate(event_fds):
+            polarity = polarities[index] if polarities is not None else (lambda: 0)
+            source.lines.append((fd, polarity, index))
+        return source
+
+    def start(self, controller):
+        if self.chip is not None:
+            self.request_lines(controller)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(controller.tick_buffer,), daemon=True)
+        self.thread.start()
+
+    def request_lines(self, controller):
+        chip_fd = os.open(self.chip, os.O_RDONLY)
+        try:
+            # kept open: the output would be released with its handle
+            self.fds.append(request_line_handle(chip_fd, controller.vio_pin, GPIOHANDLE_REQUEST_OUTPUT, 1))
+
+            for channel in controller.channels:
+                polarity_fd = request_line_handle(chip_fd, channel.polarity_pin,
+                                                  GPIOHANDLE_REQUEST_INPUT | GPIOHANDLE_REQUEST_BIAS_PULL_DOWN)
+                self.fds.append(polarity_fd)
+
+                event_fd = self.request_events(chip_fd, channel.interrupt_pin)
+                self.fds.append(event_fd)
+                self.lines.append((event_fd, LineValue(polarity_fd), channel.index))
+        finally:
+            os.close(chip_fd)
+
+    def request_events(self, chip_fd, line):
+        import fcntl
+
+        request = bytearray(GPIOEVENT_REQUEST.pack(line, GPIOHANDLE_REQUEST_INPUT | GPIOHANDLE_REQUEST_BIAS_PULL_UP,
+                                                   GPIOEVENT_REQUEST_FALLING_EDGE, CONSUMER_LABEL, 0))
+        fcntl.ioctl(chip_fd, GPIO_GET_LINEEVENT_IOCTL, request)
+        return GPIOEVENT_REQUEST.unpack(request)[-1]
+
+    def to_monotonic(self, timestamp):
+        if self.clock_correction is None:
+            if abs(timestamp - monotonic()) <= abs(timestamp - time()):
+                self.clock_correction = 0.0
+            else:
+                self.clock_correction = monotonic() - time()
+        return timestamp + self.clock_correction
+
+    def run(self, tick_buffer):
+        push = tick_buffer.push
+        read_size = GPIOEVENT_DATA.size * self.batch_size
+        lines = {fd: (polarity, index) for fd, polarity, index in self.lines}
+        # bytes of a record split across two reads (only possible with a pipe)
+        pending = {fd: b'' for fd in lines}
+
+        poll = select.poll()
+        for fd in lines:
+            poll.register(fd, select.POLLIN)
+
+        while self.running and lines:
+            for fd, _ in poll.poll(100):
+                data = os.read(fd, read_size)
+                if not data:
+                    # end of a stand-in file
+                    poll.unregister(fd)
+                    del lines[fd]
+                    continue
+
+                polarity, index = lines[fd]
+                data = pending[fd] + data
+                end = len(data) - len(data) % GPIOEVENT_DATA.size
+                pending[fd] = data[end:]
+                for timestamp, event in GPIOEVENT_DATA.iter_unpack(data[:end]):
+                    if event == GPIOEVENT_EVENT_FALLING_EDGE:
+                        push(self.to_monotonic(timestamp * 1e-9), polarity(), index)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+def read_history_file(file_name):
+    # (absolute time, direction) of every tick of a csv or binary history file
+    if file_name.endswith(".bin"):
+        records = iter_binary_history(file_name)
+        next(records)
+        yield from records
+        return
+
+    with open(file_name, 'r') as file:
+        file.readline()
+        for line in file:
+            fields = line.split(",")
+            yield float(fields[0]), int(fields[2])
+
+
+class ReplayTickSource:
+    # Replays history files, one per channel in the controller's channel order,
+    # keeping the original intervals divided by `speed`. The tick buffer has a
+    # single producer, so one thread replays every file, merging their ticks
+    # by time with a heap as SyntheticTickSource does.
+    def __init__(self, file_names, speed=1.0, loop=False):
+        if isinstance(file_names, str):
+            file_names = [file_names]
+
+        self.file_names = file_names
+        self.speed = speed
+        self.loop = loop
+        self.running = False
+        self.thread = None
+
+    def start(self, controller):
+        # the first tick of every file is read here, so that a missing or
+        # unreadable file is reported before the controller runs
+        replays = []
+        for index, file_name in enumerate(self.file_names[:len(controller.channels)]):
+            replays.append((index, file_name) + self.open_history(file_name))
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(controller.tick_buffer, replays), daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def open_history(file_name):
+        # returns the ticks of the file and its first tick (None if it has none)
+        try:
+            ticks = read_history_file(file_name)
+            return ticks, next(ticks, None)
+        except (OSError, ValueError, IndexError, struct.error) as error:
+            print(" --- ERROR: cannot replay {}: {} ---".format(file_name, error))
+            raise Exception
+
+    def run(self, tick_buffer, replays):
+        push = tick_buffer.push
+        start = monotonic()
+
+        # (time of the next tick, channel index, direction), and for every
+        # channel its file, its remaining ticks, the time of its first tick and
+        # when the current pass over it started
+        schedule = []
+        files = {}
+        for index, file_name, ticks, first_tick in replays:
+            if first_tick is None:
+                continue
+            files[index] = (file_name, ticks, first_tick[0], start)
+            heapq.heappush(schedule, (start, index, first_tick[1]))
+
+        while self.running and schedule:
+            due, index, direction = heapq.heappop(schedule)
+            if not sleep_until(due, self):
+                return
+            push(monotonic(), direction > 0, index)
+
+            file_name, ticks, first_instant, pass_start = files[index]
+            tick = next(ticks, None)
+            if tick is None:
+                if not self.loop:
+                    continue
+                # starts the file over right after its last tick
+                ticks, tick = self.open_history(file_name)
+                if tick is None:
+                    continue
+                first_instant, pass_start = tick[0], due
+                files[index] = (file_name, ticks, first_instant, pass_start)
+
+            heapq.heappush(schedule, (pass_start + (tick[0] - first_instant) / self.speed, index, tick[1]))
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,119 @@
+from tkinter import *
+from tkinter import ttk
+
+from tick_sources import cleanup_gpio
+
+# Tk user interfaces of the counter. They live in their own module so that
+# tkinter is only imported when --ui_type gui is used.
+
+
+class TkGui:
+    def __init__(self):
+        root = Tk()
+        self.root = root
+
+        self.time_elapsed = StringVar()
+        self.number_of_ticks = StringVar()
+        self.total_charge = StringVar()
+        self.avg_current = StringVar()
+        self.instant_current = StringVar()
+        self.file_name = StringVar()
+        self.resistor_value = StringVar()
+        self.charge_mc = StringVar()
+        self.std_deviation_current = StringVar()
+        self.history_queue = StringVar()
+        self.overruns = StringVar()
+
+        self.ma_period = StringVar()
+        self.number_of_positive_ticks = StringVar()
+        self.number_of_negative_ticks = StringVar()
+        self.ticks_per_second = StringVar()
+
+        self.root.title("AMP-O-METER")
+
+        self.mainframe = ttk.Frame(self.root, padding="3 3 12 12")
+        self.mainframe.grid(column=0, row=0, sticky=(N, W, E, S))
+        self.mainframe.columnconfigure(0, weight=1)
+        self.mainframe.rowconfigure(0, weight=1)
+
+        ttk.Label(self.mainframe,          textvariable=self.time_elapsed).grid(column=1, row=2, sticky=(W, E))
+        ttk.Label(self.mainframe,       textvariable=self.number_of_ticks).grid(column=2, row=2, sticky=(W, E))
+        ttk.Label(self.mainframe,           textvariable=self.avg_current).grid(column=3, row=2, sticky=(W, E))
+        ttk.Label(self.mainframe,          textvariable=self.total_charge).grid(column=4, row=2, sticky=(W, E))
+        ttk.Label(self.mainframe,        textvariable=self.resistor_value).grid(column=1, row=4, sticky=(W, E))
+        ttk.Label(self.mainframe,             textvariable=self.charge_mc).grid(column=2, row=4, sticky=(W, E))
+        ttk.Label(self.mainframe, textvariable=self.std_deviation_current).grid(column=3, row=4, sticky=(W, E))
+        ttk.Label(self.mainframe,             textvariable=self.file_name).grid(column=2, row=5, sticky=(W, E), columnspan=2)
+        ttk.Label(self.mainframe,         textvariable=self.history_queue).grid(column=2, row=6, sticky=(W, E), columnspan=2)
+        ttk.Label(self.mainframe,              textvariable=self.overruns).grid(column=2, row=7, sticky=(W, E))
+        ttk.Label(self.mainframe,       textvariable=self.instant_current).grid(column=4, row=7, sticky=(W, E))
+
+        ttk.Label(self.mainframe,       text="Time elapsed:").grid(column=1, row=1, sticky=W)
+        ttk.Label(self.mainframe,        text="Total ticks:").grid(column=2, row=1, sticky=W)
+        ttk.Label(self.mainframe,   text="Avg current (mA):").grid(column=3, row=1, sticky=W)
+        ttk.Label(self.mainframe,  text="Total charge (mC):").grid(column=4, row=1, sticky=W)
+        ttk.Label(self.mainframe,     text="Resistor value:").grid(column=1, row=3, sticky=W)
+        ttk.Label(self.mainframe,        text="mC per tick:").grid(column=2, row=3, sticky=W)
+        ttk.Label(self.mainframe, text="Std deviation (mA):").grid(column=3, row=3, sticky=W)
+        ttk.Label(self.mainframe,       text="History file:").grid(column=1, row=5, sticky=W)
+        ttk.Label(self.mainframe,      text="History queue:").grid(column=1, row=6, sticky=W)
+        ttk.Label(self.mainframe,       text="Missed ticks:").grid(column=1, row=7, sticky=W)
+        ttk.Label(self.mainframe, text="Instant current (mA):").grid(column=3, row=7, sticky=W)
+
+        # self.recharge_button = ttk.Button(self.mainframe, text="Recharge tick").grid(column=1, row=3, sticky=W)
+        self.reset_button = ttk.Button(self.mainframe, text="Reset")
+        self.reset_button.grid(column=4, row=3, sticky=W, rowspan=3)
+
+        for child in self.mainframe.winfo_children():
+            child.grid_configure(padx=5, pady=5)
+
+    def run(self):
+        try:
+            self.root.mainloop()
+        finally:
+            cleanup_gpio()
+
+
+class MultiChannelTkGui:
+    # `rows` lists the (key, description) of the rows shown for each channel
+    def __init__(self, channel_names, rows):
+        root = Tk()
+        self.root = root
+        self.root.title("AMP-O-METER")
+
+        self.mainframe = ttk.Frame(self.root, padding="3 3 12 12")
+        self.mainframe.grid(column=0, row=0, sticky=(N, W, E, S))
+
+        self.time_elapsed = StringVar()
+        self.overruns = StringVar()
+        self.rows = {}
+
+        ttk.Label(self.mainframe, text="Time elapsed:").grid(column=0, row=0, sticky=W)
+        ttk.Label(self.mainframe, textvariable=self.time_elapsed).grid(column=1, row=0, sticky=(W, E))
+        ttk.Label(self.mainframe, text="Missed ticks:").grid(column=2, row=0, sticky=W)
+        ttk.Label(self.mainframe, textvariable=self.overruns).grid(column=3, row=0, sticky=(W, E))
+
+        for column, name in enumerate(channel_names, 1):
+            ttk.Label(self.mainframe, text=name).grid(column=column, row=1, sticky=W)
+
+        for row, (key, description) in enumerate(rows, 2):
+            ttk.Label(self.mainframe, text=description + ":").grid(column=0, row=row, sticky=W)
+            self.rows[key] = [StringVar() for _ in channel_names]
+            for column, variable in enumerate(self.rows[key], 1):
+                ttk.Label(self.mainframe, textvariable=variable).grid(column=column, row=row, sticky=(W, E))
+
+        self.reset_button = ttk.Button(self.mainframe, text="Reset")
+        self.reset_button.grid(column=0, row=len(rows) + 2, sticky=W)
+
+        for child in self.mainframe.winfo_children():
+            child.grid_configure(padx=5, pady=5)
+
+    def set_row(self, key, values):
+        for variable, value in zip(self.rows[key], values):
+            variable.set(value)
+
+    def run(self):
+        try:
+            self.root.mainloop()
+        finally:
+            cleanup_gpio()